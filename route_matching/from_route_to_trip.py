@@ -1,29 +1,27 @@
+import os
 import pandas as pd
-import xml.etree.ElementTree as ET
+from village_pool import map_villages
 villages = ['erstfeld', 'goeschenen', 'gurtnellen', 'schattdorf', 'silenen', 'wassen']
 
-for village in villages:
-    # Input CSV and output XML file names
+def process_village(village):
+    # Input CSV (feather copy preferred if available) and output XML file names
     csv_file = f"output/reconstructed_trips_{village}.csv"
+    feather_file = f"output/reconstructed_trips_{village}.feather"
     output_xml = f"output/reconstructed_trips_{village}.trips.xml"
-    
-    # Load the CSV
-    df = pd.read_csv(csv_file)
+
+    # Load the trips
+    df = pd.read_feather(feather_file) if os.path.exists(feather_file) else pd.read_csv(csv_file)
     df.sort_values(by="depart", inplace=True)
-    # Create root <trips> element
-    root = ET.Element("trips")
-    
-    # Populate trip elements
-    for _, row in df.iterrows():
-        trip = ET.SubElement(root, "trip")
-        trip.set("id", row["vehID"])
-        trip.set("depart", str(row["depart"]))
-        trip.set("from", row["from"])
-        trip.set("to", row["to"])
-        trip.set("type", row["type"])
-    
-    # Save to XML
-    tree = ET.ElementTree(root)
-    tree.write(output_xml, encoding="utf-8", xml_declaration=True)
-    
+    # Cast once and name the columns like the attributes of a SUMO <trip>
+    df = df[["vehID", "depart", "from", "to", "type"]].astype(str).rename(columns={"vehID": "id"})
+
+    # Write <trips> with one <trip> per row, serialized by pandas/lxml in a single call
+    df.to_xml(output_xml, index=False, root_name="trips", row_name="trip", attr_cols=["id", "depart", "from", "to", "type"],
+              encoding="utf-8", xml_declaration=True, pretty_print=False)
+
     print(f"SUMO trip file written to {output_xml}")
+
+
+if __name__ == "__main__":
+    # Villages are independent (each writes its own files), process them in parallel
+    map_villages(process_village, villages)
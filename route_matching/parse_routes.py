@@ -1,25 +1,19 @@
 import os
-import xml.etree.ElementTree as ET
-from collections import defaultdict
-import csv
-
-# output folder creation
-os.makedirs("output", exist_ok=True)
+import pandas as pd
+from village_pool import map_villages
 
 villages = ['erstfeld', 'goeschenen', 'gurtnellen', 'schattdorf', 'silenen', 'wassen']
 
-for village in villages:
-    
+# --- Step 1: Parse the XMLs of each village into a table of sensor records ---
+columns = ["village", "vehID", "state", "time", "lane", "type", "speed"]
+
+def parse_village(village):
     print("-------------------------------------------------")
 
-    
     # --- Configuration ---
     sensor_dir = f"data/czeiter_loop_output/{village}"  # Set this to your folder with the entry/exit XML files
-    output_csv = f"output/reconstructed_trips_{village}.csv"
-    
-    # --- Step 1: Parse all XMLs into a vehicle map ---
-    vehicles = defaultdict(lambda: {"entry": None, "exit": None})
     
+    frames = []
     total_datapoints = 0
     for filename in os.listdir(sensor_dir):
         print(f"Parsing {filename}...")
@@ -38,66 +32,65 @@ for village in villages:
             print(f"Skipping {filename} (not an entry or exit file)")
             continue  # Skip irrelevant files
     
-        tree = ET.parse(filepath)
-        root = tree.getroot()
-    
-        for elem in root.findall("instantOut"): # Get all 'instantOut' elements (the output of the sensors)
-            total_datapoints += 1
-            state = elem.get("state")
-            if state != "enter" and state != "leave":
-                continue  # Only care about entry and exit times
-    
-            vehID = elem.get("vehID")
-            time = float(elem.get("time")) # saved as string in seconds originally
-            edge_id_raw = elem.get("id")  # e.g., 'erstfeld_entry_A'
-            vtype = elem.get("type")
-            speed = float(elem.get("speed"))
+        # Get all 'instantOut' elements (the output of the sensors) as a table, numbers are parsed by pandas (saved as strings in the xml)
+        try:
+            df = pd.read_xml(filepath, xpath=".//instantOut", dtype={"vehID": str, "id": str, "type": str, "time": "float64", "speed": "float64"})
+        except ValueError:
+            print(f"Skipping {filename} (no instantOut elements)")
+            continue
+        total_datapoints += len(df)
     
-            # Convert e.g. 'erstfeld_entry_A' → 'lane_entry_A'
-            if is_entry:
-                lane_id = edge_id_raw.replace(f"{village}_entry", "lane_entry")
-            else:
-                lane_id = edge_id_raw.replace(f"{village}_exit", "lane_exit")
-                
-            if state != "enter" and state != "leave":
-                print(f"Skipping {filename} (unexpected state {state})")
-                continue
-            if is_entry and state == "enter":
-                vehicles[vehID]["entry"] = {
-                    "time": time,
-                    "edge": lane_id,
-                    "type": vtype,
-                    "speed": speed
-                }
-            elif is_exit and state == "leave":
-                vehicles[vehID]["exit"] = {
-                    "time": time,
-                    "edge": lane_id,
-                    "type": vtype,
-                    "speed": speed
-                }
-                
+        # Only care about entering the entry sensors and leaving the exit sensors
+        df = df[df["state"] == ("enter" if is_entry else "leave")].copy()
+        df["village"] = village
     
-    # --- Step 2: Filter complete trips ---
-    trips = []
-    for vehID, data in vehicles.items():
-        if data["entry"] and data["exit"]: # check if both entry and exit exist
-            trips.append({
-                "vehID": vehID,
-                "depart": data["entry"]["time"],
-                "from": data["entry"]["edge"],
-                "to": data["exit"]["edge"],
-                "arrival": data["exit"]["time"],
-                "arrival_speed": data["exit"]["speed"],
-                "type": data["entry"]["type"],  # use entry type; same
-            })
+        # Convert e.g. 'erstfeld_entry_A' → 'lane_entry_A'
+        if is_entry:
+            df["lane"] = df["id"].str.replace(f"{village}_entry", "lane_entry", regex=False)
+        else:
+            df["lane"] = df["id"].str.replace(f"{village}_exit", "lane_exit", regex=False)
     
-    # --- Step 3: Save to CSV ---
-    with open(output_csv, mode='w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=[
-            "vehID", "depart", "from", "to", "arrival", "arrival_speed", "type"
-        ])
-        writer.writeheader()
-        writer.writerows(trips)
+        frames.append(df[columns])
     
-    print(f"Saved {len(trips)} trips to {output_csv} from a total of {total_datapoints} datapoints in the xml files (contains in and out and each sensor at least enter and leave state (and some random vehicles that only leave or enter) -> x4 factor minimum is realistic)")
+    records = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    return records, total_datapoints
+
+
+if __name__ == "__main__":
+    # output folder creation
+    os.makedirs("output", exist_ok=True)
+
+    # Villages are independent, parse their files in parallel
+    results = map_villages(parse_village, villages)
+    total_datapoints = {village: datapoints for village, (_, datapoints) in zip(villages, results)}
+
+    # --- Step 2: Pair entry and exit of each vehicle (for all villages at once), keep complete trips ---
+    records = pd.concat([records for records, _ in results], ignore_index=True)
+
+    # Later records overwrite earlier ones of the same vehicle and state
+    records = records.drop_duplicates(subset=["village", "vehID", "state"], keep="last")
+    entries = records[records["state"] == "enter"]
+    exits = records[records["state"] == "leave"]
+
+    # Inner join keeps only vehicles with both entry and exit
+    paired = pd.merge(entries, exits, on=["village", "vehID"], suffixes=("_in", "_out"))
+
+    # --- Step 3: Save to CSV (and feather for fast reloading in the next steps) ---
+    for village in villages:
+        output_csv = f"output/reconstructed_trips_{village}.csv"
+        village_paired = paired[paired["village"] == village]
+        
+        trips = pd.DataFrame({
+            "vehID": village_paired["vehID"].values,
+            "depart": village_paired["time_in"].values,
+            "from": village_paired["lane_in"].values,
+            "to": village_paired["lane_out"].values,
+            "arrival": village_paired["time_out"].values,
+            "arrival_speed": village_paired["speed_out"].values,
+            "type": village_paired["type_in"].values,  # use entry type; same
+        })
+        
+        trips.to_csv(output_csv, index=False)
+        trips.to_feather(output_csv.replace(".csv", ".feather"))
+        
+        print(f"Saved {len(trips)} trips to {output_csv} from a total of {total_datapoints[village]} datapoints in the xml files (contains in and out and each sensor at least enter and leave state (and some random vehicles that only leave or enter) -> x4 factor minimum is realistic)")
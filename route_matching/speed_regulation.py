@@ -1,11 +1,18 @@
+import os
+import numpy as np
 import pandas as pd
+from village_pool import map_villages
 
 villages = ['erstfeld', 'goeschenen', 'gurtnellen', 'schattdorf', 'silenen', 'wassen']
 
-for village in villages:
+def process_village(village):
  
-    # Load your parsed exit data
-    df = pd.read_csv(f"output/reconstructed_trips_{village}.csv") 
+    # Load your parsed exit data (feather copy preferred if available)
+    feather_file = f"output/reconstructed_trips_{village}.feather"
+    if os.path.exists(feather_file):
+        df = pd.read_feather(feather_file)
+    else:
+        df = pd.read_csv(f"output/reconstructed_trips_{village}.csv") 
     
     # Extract relevant columns
     df_exit = df[["arrival", "to", "arrival_speed"]].copy()
@@ -18,39 +25,33 @@ for village in villages:
     # Get all unique exit edges
     exit_edges = sorted(df_exit["exit_edge"].unique())
     
-    # Initialize storage with all -1 values
-    exit_speed_map = {edge: [-1] * (end_time - start_time + 1) for edge in exit_edges}
-    
-    # First pass: record exact arrival times and speeds
-    for _, row in df_exit.iterrows():
-        t = int(row["time"]) - start_time
-        edge = row["exit_edge"]
-        speed = row["speed"]
-        
-        # Skip entries outside our time range
-        if t < 0 or t >= len(exit_speed_map[edge]):
-            continue
-            
-        # Set the current time speed
-        exit_speed_map[edge][t] = speed
-    
-    # Second pass: fill gaps between arrivals properly
-    for edge in exit_edges:
-        last_speed = -1
-        for t in range(len(exit_speed_map[edge])):
-            if exit_speed_map[edge][t] != -1:
-                # Found a new arrival, update the last_speed
-                last_speed = exit_speed_map[edge][t]
-            elif last_speed != -1:
-                # Fill gaps with the last known speed
-                exit_speed_map[edge][t] = last_speed
+    # One row per second and one column per exit edge, -1 where no vehicle has passed
+    # (float64 like the parsed speeds, the simulation passes these values to SUMO unchanged)
+    exit_speeds = np.full((end_time - start_time + 1, len(exit_edges)), -1, dtype=np.float64)
+    
+    # Record exact arrival times and speeds
+    edge_idx = df_exit["exit_edge"].map({edge: i for i, edge in enumerate(exit_edges)}).values
+    t_idx = df_exit["time"].astype(int).values - start_time
+    
+    # Skip entries outside our time range
+    in_range = (t_idx >= 0) & (t_idx < exit_speeds.shape[0])
+    exit_speeds[t_idx[in_range], edge_idx[in_range]] = df_exit["speed"].values[in_range]
+    
+    # Fill gaps between arrivals with the last known speed: index of the last arrival up to each second (-1 stays before the first arrival)
+    last_arrival = np.where(exit_speeds != -1, np.arange(exit_speeds.shape[0], dtype=np.int32)[:, None], 0)
+    np.maximum.accumulate(last_arrival, axis=0, out=last_arrival)
+    exit_speeds = exit_speeds[last_arrival, np.arange(exit_speeds.shape[1])]
     
     # Create DataFrame
-    time_index = list(range(start_time, end_time + 1))
-    result_df = pd.DataFrame({"time": time_index})
-    for edge in exit_edges:
-        result_df[edge] = exit_speed_map[edge]
+    result_df = pd.DataFrame(exit_speeds, columns=exit_edges)
+    result_df.insert(0, "time", np.arange(start_time, end_time + 1))
     
-    # Save to CSV
+    # Save to CSV (and parquet, much smaller and faster to load for the simulation)
     result_df.to_csv(f"output/20_11_exit_speeds_per_second_{village}.csv", index=False)
+    result_df.to_parquet(f"output/20_11_exit_speeds_per_second_{village}.parquet", compression="zstd", index=False)
     print(f"output/20_11_exit_speeds_per_second_{village}.csv")
+
+
+if __name__ == "__main__":
+    # Villages are independent (each writes its own files), process them in parallel
+    map_villages(process_village, villages)
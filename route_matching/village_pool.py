@@ -0,0 +1,8 @@
+import os
+import multiprocessing as mp
+
+
+def map_villages(function, villages):
+    # Villages are independent, run function for each of them in parallel processes (results in the order of villages)
+    with mp.Pool(min(len(villages), os.cpu_count() or 1)) as pool:
+        return pool.map(function, villages)
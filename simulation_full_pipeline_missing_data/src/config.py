@@ -5,6 +5,8 @@
 # Supervised by Kevien Riehl
 #############################################
 
+from collections import namedtuple
+
 #########################################
 # General configuration for the simulation
 #########################################  
@@ -15,6 +17,7 @@ FORCE_RECALCULATE = False
 TIME_PER_SCREENSHOT = 3600 #seconds
 SHOW_INTERFACE = False # Show the SUMO interface
 REROUTING_PERIOD = 360 # rerouting period in seconds
+USE_GPU = False # Run the pollutant diffusion on a CUDA GPU (numba.cuda), falls back to the CPU if none is available
 
 #########################################
 # Define the date
@@ -114,6 +117,18 @@ VILLAGE_LARGE = "Erstfeld"
 
 
 
+#########################################
+# Bundle of the grid of the chosen village (built once, handed to the numba kernels instead of single globals)
+#########################################  
+
+GridSpec = namedtuple("GridSpec", "left right top bottom nx ny nz invdx invdy")
+GRID = GridSpec(
+    left=GRID_LEFT, right=GRID_RIGHT, top=GRID_TOP, bottom=GRID_BOTTOM,
+    nx=GRID_DIM_X, ny=GRID_DIM_Y, nz=GRID_DIM_Z,
+    invdx=GRID_DIM_X / (GRID_RIGHT - GRID_LEFT), # grid cells per SUMO unit in x-direction
+    invdy=GRID_DIM_Y / (GRID_TOP - GRID_BOTTOM)  # grid cells per SUMO unit in y-direction
+)
+
 NETWORK_FILE = f"../villages/{VILLAGE_LARGE}/{VILLAGE_NAME}_osm.net.xml"  # Path to the network file
 SUMO_FILE = f"../villages/{VILLAGE_LARGE}/{DATE}_{VILLAGE_NAME}.sumocfg" # Path to the SUMO config file
 SPEED_FILE = f"../villages/{VILLAGE_LARGE}/{DATE}_exit_speeds_per_second_{VILLAGE_NAME}.csv"  # Path to the speed file
\ No newline at end of file
@@ -9,11 +9,17 @@
 # Imports
 #########################################  
 
-import pandas as pd
 import os
+import functools
 import numpy as np
+import numba as nb
 import argparse
+import xml.etree.ElementTree as ET
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
+from concurrent.futures import ThreadPoolExecutor
+from pyproj import Proj
 from sumolib import net
 from config import GAS_HEIGHT
 
@@ -22,6 +28,21 @@ from config import GAS_HEIGHT
 # Functions
 #########################################  
 
+@functools.lru_cache(maxsize=4)
+def _load_net(filename, mtime):
+    """
+    Load a SUMO network, cached: repeated conversions reuse the parsed network instead of parsing the xml again.
+
+    Args:
+        filename (str): Path to the SUMO network file.
+        mtime (float): Modification time of the file (part of the cache key, a changed file is loaded again).
+
+    Returns:
+        sumolib.net.Net: The parsed network.
+    """
+    return net.readNet(filename)
+
+
 def convert_lat_lon_to_sumo_coordinates(lat, lon, filename, verbose=False):
     """
     Convert latitude and longitude to SUMO coordinates.
@@ -41,8 +62,8 @@ def convert_lat_lon_to_sumo_coordinates(lat, lon, filename, verbose=False):
     
     assert (feasible_lat_long(lat, lon))
 
-    # Load SUMO network
-    network = net.readNet(filename)
+    # Load SUMO network (cached)
+    network = _load_net(filename, os.path.getmtime(filename))
 
     # Convert from latitude/longitude to SUMO XY
     x, y = network.convertLonLat2XY(lon, lat)
@@ -50,6 +71,68 @@ def convert_lat_lon_to_sumo_coordinates(lat, lon, filename, verbose=False):
     return x, y
 
 
+def get_lat_lon_to_sumo_converter(filename, verbose=False):
+    """
+    Read the projection of a SUMO network once and return a function converting latitudes and longitudes to SUMO coordinates.
+    Only the location information of the network file is read (no need to load the whole net).
+
+    Args:
+        filename (str): Path to the SUMO network file.
+        verbose(bool): If more stuff should be printed
+
+    Returns:
+        function: convert(lat, lon) -> (x, y), works on single values and on numpy arrays.
+    """
+
+    printv(f"Start function get_lat_lon_to_sumo_converter for {filename}",
+           verbose=verbose, color="blue")
+
+    # Read projection and offset from the <location> element (first element of the network)
+    for _, elem in ET.iterparse(filename, events=("end",)):
+        if elem.tag == "location":
+            net_offset = [float(v) for v in elem.get("netOffset").split(",")]
+            proj_parameter = elem.get("projParameter")
+            break
+        elem.clear()
+    else:
+        raise ValueError(f"No <location> element in the network file {filename}, cannot convert coordinates")
+
+    # Same projection as sumolib's convertLonLat2XY
+    projection = Proj(projparams=proj_parameter)
+
+    def convert(lat, lon):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+
+        assert (np.all(feasible_lat_long(lat, lon)))
+
+        x, y = projection(lon, lat)
+
+        return x + net_offset[0], y + net_offset[1]
+
+    return convert
+
+
+def convert_lat_lon_to_sumo_coordinates_bulk(lat_arr, lon_arr, filename, verbose=False):
+    """
+    Convert arrays of latitudes and longitudes to SUMO coordinates in one vectorized projection.
+
+    Args:
+        lat_arr (numpy 1D array): Latitudes in degrees.
+        lon_arr (numpy 1D array): Longitudes in degrees.
+        filename (str): Path to the SUMO network file.
+        verbose(bool): If more stuff should be printed
+
+    Returns:
+        tuple: Numpy arrays of SUMO coordinates (x, y).
+    """
+
+    printv(f"Start function convert_lat_lon_to_sumo_coordinates_bulk for {len(lat_arr)} coordinates",
+           verbose=verbose, color="blue")
+
+    return get_lat_lon_to_sumo_converter(filename, verbose=verbose)(lat_arr, lon_arr)
+
+
 def convert_sumo_coordinates_to_lat_lon(x, y, filename, verbose=False):
     """
     Convert SUMO coordinates to latitude and longitude.
@@ -67,8 +150,8 @@ def convert_sumo_coordinates_to_lat_lon(x, y, filename, verbose=False):
     printv(f"Start function convert_sumo_coordinates_to_lat_lon for {x} and {y}",
            verbose=verbose, color="blue")
 
-    # Load SUMO network
-    network = net.readNet(filename)
+    # Load SUMO network (cached)
+    network = _load_net(filename, os.path.getmtime(filename))
 
     # Convert from SUMO XY to latitude/longitude
     lon, lat = network.convertXY2LonLat(x, y)
@@ -85,11 +168,11 @@ def convert_sumo_coordinates_to_grid_x_y(grid_left, grid_right, grid_bottom, gri
     Args:
         grid_left, grid_right, grid_bottom, grid_top (float): boundaries of the grid.
         size_x, size_y (unsigned int): dimensions of our grid
-        sumo_x, sumo_y (float): coordinates of sumo
+        sumo_x, sumo_y (float or numpy array): coordinates of sumo
         verbose (bool): If more information should be printed.
 
     Returns:
-        Tuple of coordinates in our grid (x, y)
+        Tuple of coordinates in our grid (x, y), ints for single coordinates, int numpy arrays for arrays
     """
 
     printv("Start function convert_sumo_coordinates_to_grid_x_y",
@@ -100,9 +183,36 @@ def convert_sumo_coordinates_to_grid_x_y(grid_left, grid_right, grid_bottom, gri
     cell_width = (grid_right - grid_left) / size_x
     cell_height = (grid_top - grid_bottom) / size_y
 
-    x = int((sumo_x - grid_left) / cell_width)
-    y = int((sumo_y - grid_bottom) / cell_height)
+    if np.isscalar(sumo_x) and np.isscalar(sumo_y):
+        x = int((sumo_x - grid_left) / cell_width)
+        y = int((sumo_y - grid_bottom) / cell_height)
+    else:
+        # Whole arrays at once in a compiled loop (no temporary arrays)
+        sumo_x, sumo_y = np.broadcast_arrays(np.asarray(sumo_x, dtype=np.float64), np.asarray(sumo_y, dtype=np.float64))
+        x, y = _grid_xy_core(sumo_x.ravel(), sumo_y.ravel(), float(grid_left), float(grid_bottom), float(cell_width), float(cell_height))
+        x, y = x.reshape(sumo_x.shape), y.reshape(sumo_y.shape)
+
+    return x, y
+
 
+@nb.njit(cache=True)
+def _grid_xy_core(sumo_x, sumo_y, grid_left, grid_bottom, cell_width, cell_height):
+    """
+    Grid cells of arrays of sumo coordinates (truncation towards zero like int()).
+
+    Args:
+        sumo_x, sumo_y (numpy 1D array): coordinates of sumo
+        grid_left, grid_bottom (float): lower boundaries of the grid.
+        cell_width, cell_height (float): size of a cell in sumo coordinates
+
+    Returns:
+        Tuple of int numpy arrays (x, y)
+    """
+    x = np.empty(sumo_x.shape[0], dtype=np.int64)
+    y = np.empty(sumo_y.shape[0], dtype=np.int64)
+    for i in range(sumo_x.shape[0]):
+        x[i] = int((sumo_x[i] - grid_left) / cell_width)
+        y[i] = int((sumo_y[i] - grid_bottom) / cell_height)
     return x, y
 
 
@@ -126,17 +236,18 @@ def parse_args():
 def feasible_lat_long(lat, long, verbose=False):
     """
     Check if the given latitude and longitude are within the bounds of Switzerland.
+    Works element-wise on numpy arrays (one vectorized check for a whole batch of coordinates).
 
     Args:
-        lat (float): Latitude in degrees.
-        long (float): Longitude in degrees.
+        lat (float or numpy array): Latitude in degrees.
+        long (float or numpy array): Longitude in degrees.
         verbose(bool): If more stuff should be printed
 
     Returns:
-        bool: True if the coordinates are within Switzerland, False otherwise.
+        bool (or numpy bool array): True if the coordinates are within Switzerland, False otherwise.
     """
     printv("Start function feasible_lat_long", verbose=verbose, color="blue")
-    return (lat >= 40 and lat <= 50) and (long >= 5 and long <= 10)
+    return (lat >= 40) & (lat <= 50) & (long >= 5) & (long <= 10)
 
 
 def printv(message, verbose=True, color=None, decorate=False, info=True):
@@ -191,9 +302,11 @@ def printv(message, verbose=True, color=None, decorate=False, info=True):
             print(lines)
 
 
+@functools.lru_cache(maxsize=8)
 def get_cell_size(grid_left, grid_right, grid_bottom, grid_top, size_x, size_y, filename, verbose=False):
     """
     Calculate the size in real life [m] of each cell in the grid.
+    Cached: repeated calls with the same grid and network return the stored result.
 
     Args:
         grid_left, grid_right, grid_bottom, grid_top (float): boundaries of the grid in sumo coords.
@@ -210,10 +323,11 @@ def get_cell_size(grid_left, grid_right, grid_bottom, grid_top, size_x, size_y,
 
     assert (size_x > 0 and size_y > 0)
 
-    bottom_left_lat, bottom_left_lon = convert_sumo_coordinates_to_lat_lon(
-        grid_left, grid_bottom, filename, verbose=verbose)
-    top_right_lat, top_right_lon = convert_sumo_coordinates_to_lat_lon(
-        grid_right, grid_top, filename, verbose=verbose)
+    # Convert both corners with one loaded network
+    network = _load_net(filename, os.path.getmtime(filename))
+    bottom_left_lon, bottom_left_lat = network.convertXY2LonLat(grid_left, grid_bottom)
+    top_right_lon, top_right_lat = network.convertXY2LonLat(grid_right, grid_top)
+    assert (feasible_lat_long(bottom_left_lat, bottom_left_lon) and feasible_lat_long(top_right_lat, top_right_lon))
 
     # Calculate the distances between the corners of the grid
 
@@ -263,8 +377,7 @@ def array_to_csv(array, csv_name, folder_path, verbose=False):
            verbose=verbose, color="blue", decorate=True)
     save_path = folder_path+csv_name+".csv"
     print(save_path)
-    df = pd.DataFrame(array)
-    df.to_csv(save_path, index=False)
+    write_grid_csv(array, save_path)
 
 
 def save_vec_to_csv(data_array, data_folder, filename):
@@ -276,12 +389,65 @@ def save_vec_to_csv(data_array, data_folder, filename):
         data_folder: Path to the data folder
         filename: Name of the output file
     """
-    df = pd.DataFrame(data_array)
     output_file = os.path.join(data_folder, filename)
-    df.to_csv(output_file, index=False)
+    write_grid_csv(data_array, output_file)
+
+
+def write_grid_csv(array, file_path):
+    """
+    Write a 2D array to a CSV file in the layout of pandas' DataFrame(array).to_csv(file_path, index=False):
+    header row with the column numbers, NaN as empty field. Written with pyarrow (multithreaded), much faster than pandas.
+    Floats are written in their shortest exact form (e.g. 0 instead of 0.0), load_grid reads them back exactly.
+
+    Args:
+        array: NumPy array (1D arrays are written as a single column)
+        file_path: Path to the CSV file
+    """
+    array = np.asarray(array)
+    if array.ndim == 1:
+        array = array.reshape(-1, 1)
+    table = pa.table({str(i): pa.array(array[:, i], from_pandas=True) for i in range(array.shape[1])})
+    pa_csv.write_csv(table, file_path, pa_csv.WriteOptions(quoting_header="none"))
+
+
+def load_grid(file_path):
+    """
+    Load a grid saved with save_vec_to_csv (header row with the column numbers) as a float array.
+    Parsed with pyarrow (multithreaded, exact float round trip), faster than pd.read_csv(...).values.
+
+    Args:
+        file_path: Path to the CSV file
+
+    Returns:
+        numpy 2D array: The grid (empty cells are NaN)
+    """
+    table = pa_csv.read_csv(file_path)
+    return np.column_stack([column.cast(pa.float64()).to_numpy(zero_copy_only=False) for column in table.columns])
+
+
+def map_in_threads(function, tasks, max_workers=None):
+    """
+    Apply a function to every task in parallel threads and return the results in order.
+    Threads instead of processes: run_sim.py has already started numba's threading layer when this runs,
+    and forking after that is unsafe (OpenMP). The heavy parts of the tasks (numba nogil kernels, pyarrow, numpy) release the GIL.
+
+    Args:
+        function: Function, called with one task
+        tasks (list): Argument of every call
+        max_workers (int): Maximum number of threads (default: number of cpus)
+
+    Returns:
+        list: Results of the function, in the order of the tasks
+    """
+    if not tasks:
+        return []
+
+    max_workers = min(len(tasks), max_workers or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(function, tasks))
 
 
-def save_all_data(co_vector_global, nox_vector_global, pmx_vector_global, cell_len_x_m, cell_len_y_m, cell_len_z_m, noise_vector, folder_path="../output/data/", verbose=False, identifier="default"):
+def save_all_data(co_vector_global, nox_vector_global, pmx_vector_global, cell_len_x_m, cell_len_y_m, cell_len_z_m, noise_vector, folder_path="../output/data/", verbose=False, identifier="default", io_pool=None):
     """ 
     Save all the different arrays to csv files.
 
@@ -293,15 +459,12 @@ def save_all_data(co_vector_global, nox_vector_global, pmx_vector_global, cell_l
         folder_path (str): Path to the folder where the CSV files will be saved.
         verbose (bool): If True, prints additional information.
         identifier (str): Identifier for the output files.
-    Outputs:
-        None (only saves to files)
+        io_pool: Optional ThreadPoolExecutor to write the files in the background (the gas slices are copied before returning,
+            the gas arrays may change afterwards, noise_vector must not)
+    Returns:
+        List of futures of the pending writes (empty without io_pool)
 
     """
-    # make vectors 2D (only take a slice of the z-axis)
-    co_vector = co_vector_global[:, :, GAS_HEIGHT]
-    nox_vector = nox_vector_global[:, :, GAS_HEIGHT]
-    pmx_vector = pmx_vector_global[:, :, GAS_HEIGHT]
-
     printv("Start function save_all_data",
            verbose=verbose, color="blue", decorate=True)
 
@@ -311,11 +474,19 @@ def save_all_data(co_vector_global, nox_vector_global, pmx_vector_global, cell_l
     # convert concentration from mg/cell to mg/m³
     mg_per_cell_to_mg_per_m3 = 1 / (cell_len_x_m * cell_len_y_m * cell_len_z_m)
 
-    array_to_csv(co_vector*mg_per_cell_to_mg_per_m3, f"data_co_{GAS_HEIGHT}_{identifier}", folder_path)
+    # make vectors 2D (only take a slice of the z-axis), scaled straight into one buffer for all gases (no temporary per gas)
+    gas_vectors = (co_vector_global, nox_vector_global, pmx_vector_global)
+    gases = np.empty((len(gas_vectors),) + co_vector_global.shape[:2])
+    for gas_index, gas_vector_global in enumerate(gas_vectors):
+        np.multiply(gas_vector_global[:, :, GAS_HEIGHT], mg_per_cell_to_mg_per_m3, out=gases[gas_index])
 
-    array_to_csv(nox_vector*mg_per_cell_to_mg_per_m3, f"data_nox_{GAS_HEIGHT}_{identifier}", folder_path)
-
-    array_to_csv(pmx_vector*mg_per_cell_to_mg_per_m3, f"data_pmx_{GAS_HEIGHT}_{identifier}", folder_path)
+    outputs = [(gas_vector, f"data_{gas_name}_{GAS_HEIGHT}_{identifier}") for gas_name, gas_vector in zip(("co", "nox", "pmx"), gases)]
 
     # Save noise (anyways only 2D)
-    array_to_csv(noise_vector, f"data_noise_{identifier}", folder_path)
\ No newline at end of file
+    outputs.append((noise_vector, f"data_noise_{identifier}"))
+
+    if io_pool is None:
+        for array, name in outputs:
+            array_to_csv(array, name, folder_path)
+        return []
+    return [io_pool.submit(array_to_csv, array, name, folder_path) for array, name in outputs]
\ No newline at end of file
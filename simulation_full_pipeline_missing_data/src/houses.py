@@ -10,9 +10,16 @@
 #########################################  
 
 import os
+import shelve
+import functools
 import pandas as pd
 import requests
+import requests_cache
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 from helper import convert_sumo_coordinates_to_lat_lon, printv
@@ -20,10 +27,46 @@ from config import GRID_LEFT, GRID_RIGHT, GRID_BOTTOM, GRID_TOP
 
 
 
+# Values of the OSM building tag of buildings where people live
+HOUSE_BUILDING_TYPES = ['house', 'residential', 'detached', 'semidetached_house',
+                        'terrace', 'apartments', 'hotel', 'farm_auxiliary', 'yes', 'farm', 'farm_auxiliary', 'bungalow', 'cabin', 'annexe', 'dormitory', 'static_caravan']
+
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+OVERPASS_BATCH_SIZE = 50  # Number of ways fetched with one Overpass query
+OVERPASS_MAX_WORKERS = 2  # Parallel Overpass requests (overpass-api.de only gives each IP a couple of request slots)
+OVERPASS_CACHE_DIR = "../output/temp"  # Folder of the on-disk cache of the Overpass answers if no other is given
+
+
+
 #########################################
 # Functions
 #########################################  
 
+@functools.lru_cache(maxsize=None)
+def get_overpass_session(cache_dir=OVERPASS_CACHE_DIR):
+    """
+    Shared HTTP session for the Overpass API, created on first use (reuses connections instead of a new TCP+TLS handshake per house).
+    429/5xx answers are retried with backoff.
+
+    Args:
+        cache_dir (str): Folder of the on-disk (sqlite) cache of the answers, identical queries of later runs are not sent again.
+            None for a session without cache (e.g. when recalculating)
+
+    Returns:
+        requests.Session: The session (one per cache_dir)
+    """
+    if cache_dir is None:
+        session = requests.Session()
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        session = requests_cache.CachedSession(os.path.join(cache_dir, "http_cache"), backend="sqlite", expire_after=timedelta(days=30),
+                                               allowable_codes=(200,), allowable_methods=("GET", "POST"))
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64,
+                                          max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504],
+                                                            allowed_methods=frozenset({"POST"}), respect_retry_after_header=True)))
+    return session
+
+
 def create_geolocator(user_agent="bachelor_thesis_eth", delay=1.0, verbose=False):
     """
     Create a geolocator and rate-limited reverse geocode function.
@@ -46,9 +89,9 @@ def create_geolocator(user_agent="bachelor_thesis_eth", delay=1.0, verbose=False
     return geocode
 
 
-def get_building_info(lat, lon, geocode_func, verbose=False):
+def reverse_geocode(lat, lon, geocode_func, verbose=False):
     """
-    Query Nominatim reverse geocoder for a building at (lat, lon) and try to fetch its polygon.
+    Query Nominatim reverse geocoder for the object at (lat, lon). Stage 1 of get_building_info (rate limited, run serially).
 
     Args:
         lat (float): Latitude in degrees.
@@ -57,130 +100,256 @@ def get_building_info(lat, lon, geocode_func, verbose=False):
         verbose(bool): If more stuff should be printed
 
     Returns:
-        dictionary with all kinds of data about the given lat, lon
-
+        dict: Raw Nominatim answer, None if nothing was found or the call failed
     """
-    printv("Start function get_building_info", verbose=verbose, color="blue")
+    printv("Start function reverse_geocode", verbose=verbose, color="blue")
 
     try:
         location = geocode_func((lat, lon), exactly_one=True)
         if location:
-            address = location.raw.get('address', {})
-            osm_id = location.raw.get('osm_id')
-            osm_type = location.raw.get('osm_type')
+            return location.raw
+    except Exception as e:
+        printv(f"[ERROR] ({lat}, {lon}): {e}", verbose=verbose, color="red")
+
+    return None
+
+
+def fetch_building_polygon(osm_type, osm_id, session=None, verbose=False):
+    """
+    Fetch an OSM object from the Overpass API and extract its polygon if it is a building where people live.
+    Stage 2 of get_building_info (no shared rate limit, can run in parallel threads).
+
+    Args:
+        osm_type (str): OSM type of the object ('node', 'way' or 'relation')
+        osm_id (int): OSM id of the object
+        session (requests.Session): Session used for the Overpass API calls (default: get_overpass_session())
+        verbose(bool): If more stuff should be printed
+
+    Returns:
+        dict with 'polygon', 'building_type' and 'is_house', None if the object could not be fetched
+    """
+    printv("Start function fetch_building_polygon", verbose=verbose, color="blue")
+
+    if session is None:
+        session = get_overpass_session()
+
+    if not (osm_id and osm_type):
+        return None
+
+    try:
+        # Convert type to Overpass API style: N, W, R
+        type_map = {"node": "N", "way": "W", "relation": "R"}
+        osm_type_letter = type_map.get(osm_type)
+
+        if not osm_type_letter:
+            return None
+
+        query = f"""
+        [out:json];
+        {osm_type}({osm_id});
+        out body;
+        >;
+        out skel qt;
+        """
+        response = session.post(OVERPASS_URL, data=query, timeout=(5, 30))
+        if response.status_code != 200:
+            return None
+        data = response.json()
+
+        # Check if this way is a house/residential building
+        is_house = False
+        building_type = None
+        polygon = None
+
+        for elem in data['elements']:
+            if elem['type'] == 'way' and 'tags' in elem:
+                tags = elem.get('tags', {})
+
+                printv(f"house type (check for weird stuff): {tags.get('building')}", verbose=verbose)
+                # Check building tag (manually saw that besides the normal housing names, sometimes OSM also just hase house: yes)
+                if tags.get('building') in HOUSE_BUILDING_TYPES:
+                    is_house = True
+                    building_type = tags.get('building')
+                    break
+
+        # Only if it is a building where people live
+        if is_house:
+            nodes = {elem['id']: (
+                elem['lon'], elem['lat']) for elem in data['elements'] if elem['type'] == 'node'}
+            for elem in data['elements']:
+                if elem['type'] == 'way' and 'nodes' in elem:
+                    coords = [
+                        nodes[node_id] for node_id in elem['nodes'] if node_id in nodes]
+                    if coords:
+                        polygon = "POLYGON((" + ", ".join(
+                            f"{lon} {lat}" for lon, lat in coords) + "))"
+                        break
+
+        return {'polygon': polygon, 'building_type': building_type, 'is_house': is_house}
+    except Exception as e:
+        printv(f"[WARNING] Failed to fetch OSM polygon: {e}", verbose=verbose, color="red")
+
+    return None
+
+
+def fetch_way_polygons(way_ids, session=None, verbose=False):
+    """
+    Fetch several OSM ways with a single Overpass query and extract their polygons if they are buildings where people live.
+    Gives the same result per way as fetch_building_polygon, but with one request for the whole batch.
+
+    Args:
+        way_ids (list of int): OSM ids of the ways
+        session (requests.Session): Session used for the Overpass API calls (default: get_overpass_session())
+        verbose(bool): If more stuff should be printed
+
+    Returns:
+        dict: way id -> dict with 'polygon', 'building_type' and 'is_house', empty if the batch could not be fetched
+    """
+    printv(f"Start function fetch_way_polygons for {len(way_ids)} ways", verbose=verbose, color="blue")
 
+    if session is None:
+        session = get_overpass_session()
+
+    try:
+        query = f"""
+        [out:json];
+        way(id:{",".join(str(way_id) for way_id in way_ids)});
+        out body;
+        >;
+        out skel qt;
+        """
+        response = session.post(OVERPASS_URL, data=query, timeout=(5, 60))
+        if response.status_code != 200:
+            return {}
+        data = response.json()
+
+        nodes = {elem['id']: (elem['lon'], elem['lat']) for elem in data['elements'] if elem['type'] == 'node'}
+        ways = {elem['id']: elem for elem in data['elements'] if elem['type'] == 'way'}
+
+        buildings = {}
+        for way_id in way_ids:
+            way = ways.get(way_id, {})
+            building_type = None
             polygon = None
 
-            # Try to fetch polygon if type and id are available
-            if osm_id and osm_type:
-                try:
-                    # Convert type to Overpass API style: N, W, R
-                    type_map = {"node": "N", "way": "W", "relation": "R"}
-                    osm_type_letter = type_map.get(osm_type)
-
-                    if osm_type_letter:
-                        overpass_url = "https://overpass-api.de/api/interpreter"
-                        query = f"""
-                        [out:json];
-                        {osm_type}({osm_id});
-                        out body;
-                        >;
-                        out skel qt;
-                        """
-                        response = requests.post(overpass_url, data=query)
-                        if response.status_code == 200:
-                            data = response.json()
-
-                            # Check if this way is a house/residential building
-                            is_house = False
-                            building_type = None
-
-                            for elem in data['elements']:
-                                if elem['type'] == 'way' and 'tags' in elem:
-                                    tags = elem.get('tags', {})
-
-                                    print(
-                                        "house type (check for weird stuff):", tags.get('building'))
-                                    # Check building tag (manually saw that besides the normal housing names, sometimes OSM also just hase house: yes)
-                                    if tags.get('building') in ['house', 'residential', 'detached', 'semidetached_house',
-                                                                'terrace', 'apartments', 'hotel', 'farm_auxiliary', 'yes', 'farm', 'farm_auxiliary', 'bungalow', 'cabin', 'annexe', 'dormitory', 'static_caravan']:
-                                        is_house = True
-                                        building_type = tags.get('building')
-                                        break
-
-                            # Only if it is a building where people live
-                            if is_house:
-                                nodes = {elem['id']: (
-                                    elem['lon'], elem['lat']) for elem in data['elements'] if elem['type'] == 'node'}
-                                for elem in data['elements']:
-                                    if elem['type'] == 'way' and 'nodes' in elem:
-                                        coords = [
-                                            nodes[node_id] for node_id in elem['nodes'] if node_id in nodes]
-                                        if coords:
-                                            polygon = "POLYGON((" + ", ".join(
-                                                f"{lon} {lat}" for lon, lat in coords) + "))"
-                                            break
-
-                            else:
-                                # If it is not a house, just return the data without polygon
-                                polygon = None
-                                is_house = False
-                                building_type = None
-
-                            # Add building type to the return data
-                            return {
-                                'lat': lat,
-                                'lon': lon,
-                                'place_id': location.raw.get('place_id'),
-                                'osm_type': osm_type,
-                                'osm_id': osm_id,
-                                'house_number': address.get('house_number'),
-                                'road': address.get('road'),
-                                'polygon': polygon,
-                                'village': address.get('village'),
-                                'state': address.get('state'),
-                                'postcode': address.get('postcode'),
-                                'bounding_box': location.raw.get('boundingbox'),
-                                'building_type': building_type,
-                                'is_house': is_house
-                            }
-                except Exception as e:
-                    printv(f"[WARNING] Failed to fetch OSM polygon: {e}", verbose=verbose, color="red")
-
-            return {
-                'lat': lat,
-                'lon': lon,
-                'place_id': location.raw.get('place_id'),
-                'osm_type': osm_type,
-                'osm_id': osm_id,
-                'house_number': address.get('house_number'),
-                'road': address.get('road'),
-                'polygon': polygon,
-                'village': address.get('village'),
-                'state': address.get('state'),
-                'postcode': address.get('postcode'),
-                'bounding_box': location.raw.get('boundingbox')
-            }
+            # Check if this way is a house/residential building
+            tags = way.get('tags')
+            if tags is not None:
+                printv(f"house type (check for weird stuff): {tags.get('building')}", verbose=verbose)
+            is_house = tags is not None and tags.get('building') in HOUSE_BUILDING_TYPES
+
+            # Only if it is a building where people live
+            if is_house:
+                building_type = tags.get('building')
+                coords = [nodes[node_id] for node_id in way.get('nodes', []) if node_id in nodes]
+                if coords:
+                    polygon = "POLYGON((" + ", ".join(f"{lon} {lat}" for lon, lat in coords) + "))"
+
+            buildings[way_id] = {'polygon': polygon, 'building_type': building_type, 'is_house': is_house}
+
+        return buildings
     except Exception as e:
-        printv(f"[ERROR] ({lat}, {lon}): {e}", verbose=verbose, color="red")
+        printv(f"[WARNING] Failed to fetch OSM polygons: {e}", verbose=verbose, color="red")
+
+    return {}
+
+
+def build_building_record(lat, lon, raw, building=None):
+    """
+    Combine the results of both stages into the record returned by get_building_info.
 
-    return {
+    Args:
+        lat (float): Latitude in degrees.
+        lon (float): Longitude in degrees.
+        raw (dict): Answer of reverse_geocode (None if nothing was found)
+        building (dict): Answer of fetch_building_polygon (None if not available)
+
+    Returns:
+        dictionary with all kinds of data about the given lat, lon
+    """
+    if raw is None:
+        raw = {}
+    address = raw.get('address', {})
+
+    record = {
         'lat': lat,
         'lon': lon,
-        'place_id': None,
-        'osm_type': None,
-        'osm_id': None,
-        'house_number': None,
-        'road': None,
+        'place_id': raw.get('place_id'),
+        'osm_type': raw.get('osm_type'),
+        'osm_id': raw.get('osm_id'),
+        'house_number': address.get('house_number'),
+        'road': address.get('road'),
         'polygon': None,
-        'village': None,
-        'state': None,
-        'postcode': None,
-        'bounding_box': None
+        'village': address.get('village'),
+        'state': address.get('state'),
+        'postcode': address.get('postcode'),
+        'bounding_box': raw.get('boundingbox')
     }
 
+    # Add building type to the return data
+    if building is not None:
+        record['polygon'] = building['polygon']
+        record['building_type'] = building['building_type']
+        record['is_house'] = building['is_house']
+
+    return record
+
+
+def geocode_cache_key(lat, lon):
+    """
+    Key of a coordinate in the persistent geocode cache (rounded, so near-identical floats collapse).
+
+    Args:
+        lat (float): Latitude in degrees.
+        lon (float): Longitude in degrees.
+
+    Returns:
+        str: Cache key
+    """
+    return f"{round(lat, 6)}_{round(lon, 6)}"
+
+
+def get_building_info(lat, lon, geocode_func, session=None, cache=None, recalculate=False, verbose=False):
+    """
+    Query Nominatim reverse geocoder for a building at (lat, lon) and try to fetch its polygon.
+
+    Args:
+        lat (float): Latitude in degrees.
+        lon (float): Longitude in degrees.
+        geocode_func (function): Geolocator function for reverse calls
+        session (requests.Session): Session used for the Overpass API calls (default: get_overpass_session(), without cache when recalculating)
+        cache (shelve.Shelf): Persistent cache of earlier results (optional)
+        recalculate (bool): If True, the caches are not read (the answer is fetched again and replaces the cached one)
+        verbose(bool): If more stuff should be printed
+
+    Returns:
+        dictionary with all kinds of data about the given lat, lon
+
+    """
+    printv("Start function get_building_info", verbose=verbose, color="blue")
+
+    if session is None:
+        session = get_overpass_session(None if recalculate else OVERPASS_CACHE_DIR)
+
+    key = geocode_cache_key(lat, lon)
+    if cache is not None and not recalculate and key in cache:
+        return cache[key]
+
+    raw = reverse_geocode(lat, lon, geocode_func, verbose=verbose)
+    building = None
+    if raw is not None:
+        building = fetch_building_polygon(raw.get('osm_type'), raw.get('osm_id'), session=session, verbose=verbose)
 
-def get_house_polygons(list_coords, netfile, recalculate=False, verbose=True, output_dir="../output/temp"):
+    record = build_building_record(lat, lon, raw, building)
+
+    # Only cache complete answers (Nominatim and Overpass), failed calls of either stage are retried in the next run
+    if cache is not None and building is not None:
+        cache[key] = record
+
+    return record
+
+
+def get_house_polygons(list_coords, netfile, recalculate=False, verbose=True, output_dir="../output/temp", session=None, max_workers=OVERPASS_MAX_WORKERS):
     """
     Convert multiple SUMO coordinates to lat/lon and retrieve building info from Nominatim API.
 
@@ -192,7 +361,10 @@ def get_house_polygons(list_coords, netfile, recalculate=False, verbose=True, ou
         netfile (str): Path to SUMO .net.xml file.
         recalculate (bool): If True, force re-fetching data.
         verbose (bool): Print extra info.
-        output_dir (str): Directory to store result CSV.
+        output_dir (str): Directory to store result CSV (and the caches of the API answers).
+        session (requests.Session): Session used for the Overpass API calls
+            (default: get_overpass_session() with its cache in output_dir, without cache when recalculating)
+        max_workers (int): Number of threads for the Overpass API calls (at most the request slots Overpass gives an IP)
 
     Returns:
         pd.DataFrame: DataFrame with lat, lon, bounding_box and Polygon shape for all given coords.
@@ -220,31 +392,82 @@ def get_house_polygons(list_coords, netfile, recalculate=False, verbose=True, ou
     printv("Start converting latlon coords", verbose=verbose)
     latlon_coords = [convert_sumo_coordinates_to_lat_lon(x, y, netfile) for x, y in list_coords]
 
+    # Duplicate coordinates would only result in duplicate API calls
+    latlon_coords = list({geocode_cache_key(lat, lon): (lat, lon) for lat, lon in latlon_coords}.values())
+
     # Set up geocode function
     geocode = create_geolocator()
 
-    printv("Start fetching information", verbose=verbose)
-    # Fetch building info
-    records = [get_building_info(lat, lon, geocode) for lat, lon in latlon_coords]
-
-    # Make dataframe out of records
-    df = pd.DataFrame(records)
+    # Overpass answers are cached next to the results, recalculating bypasses that cache
+    if session is None:
+        session = get_overpass_session(None if recalculate else output_dir)
 
-    # only keep the ones of type "way", the rest are api errors
-    house_polygons = df[df['osm_type'] == 'way'].copy()
-
-    # Only keep rows with is_house == True
-    house_polygons = house_polygons[house_polygons['is_house'] == True].copy()
-
-    # Keep only relevant columns
-    house_polygons = house_polygons[['lat', 'lon', 'bounding_box', 'polygon']]
-
-    # Deduplicate based on osm_id (only keep unique buildings)
-    if 'osm_id' in house_polygons.columns:
-        house_polygons = house_polygons.dropna(subset=['osm_id']).drop_duplicates(subset=['osm_id'])
-
-    house_polygons.to_csv(output_file, index=False)
-
-    printv(f"Saved data to {output_file}", verbose=verbose)
+    printv("Start fetching information", verbose=verbose)
+    # Persistent cache of earlier API answers, keyed by rounded (lat, lon) -> survives across runs
+    # (not read when recalculating, the fresh answers replace the cached ones)
+    with shelve.open(os.path.join(output_dir, "geocode_cache")) as cache:
+        records = {}
+        missing = []
+        for lat, lon in latlon_coords:
+            key = geocode_cache_key(lat, lon)
+            if not recalculate and key in cache:
+                records[key] = cache[key]
+            else:
+                missing.append((lat, lon))
+        printv(f"{len(records)} coordinates found in the geocode cache, {len(missing)} to fetch", verbose=verbose)
+
+        # Stage 1: reverse geocoding, serially because of the Nominatim rate limit
+        raws = [reverse_geocode(lat, lon, geocode) for lat, lon in missing]
+
+        # Stage 2: Overpass lookups are only network bound, fetch them in parallel (few threads, Overpass limits the requests per IP)
+        # Ways (the only objects kept in the end) are fetched in batches with one query each, other objects one by one
+        way_ids = list(dict.fromkeys(raw['osm_id'] for raw in raws if raw is not None and raw.get('osm_type') == 'way' and raw.get('osm_id')))
+        way_batches = [way_ids[i:i + OVERPASS_BATCH_SIZE] for i in range(0, len(way_ids), OVERPASS_BATCH_SIZE)]
+
+        def fetch(raw):
+            if raw is None or raw.get('osm_type') == 'way':
+                return None
+            return fetch_building_polygon(raw.get('osm_type'), raw.get('osm_id'), session=session)
+
+        failed_batches = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            way_buildings = {}
+            for batch_buildings in executor.map(lambda batch: fetch_way_polygons(batch, session=session), way_batches):
+                # Empty answer -> the batch could not be fetched (even after the retries)
+                if not batch_buildings:
+                    failed_batches += 1
+                way_buildings.update(batch_buildings)
+            buildings = list(executor.map(fetch, raws))
+
+        buildings = [way_buildings.get(raw.get('osm_id')) if raw is not None and raw.get('osm_type') == 'way' else building
+                     for raw, building in zip(raws, buildings)]
+
+        # Combine both stages into one record per coordinate, only cache complete answers (failed calls of either stage are retried next run)
+        for (lat, lon), raw, building in zip(missing, raws, buildings):
+            key = geocode_cache_key(lat, lon)
+            records[key] = build_building_record(lat, lon, raw, building)
+            if building is not None:
+                cache[key] = records[key]
+
+    records = [records[geocode_cache_key(lat, lon)] for lat, lon in latlon_coords]
+
+    # Make dataframe out of records (column by column, records without building info have no is_house/building_type)
+    columns = ['lat', 'lon', 'osm_type', 'osm_id', 'bounding_box', 'polygon', 'is_house']
+    df = pd.DataFrame({column: [record.get(column) for record in records] for column in columns})
+
+    # only keep the ones of type "way" (the rest are api errors) that are houses, one row per building (osm_id)
+    mask = (df['osm_type'] == 'way') & (df['is_house'] == True) & df['osm_id'].notna()
+    house_polygons = (df.loc[mask, ['osm_id', 'lat', 'lon', 'bounding_box', 'polygon']]
+                      .drop_duplicates(subset=['osm_id'])
+                      .drop(columns=['osm_id'])
+                      .reset_index(drop=True))
+
+    # Houses of failed batches are missing -> do not save the result, the next run fetches them again (the complete answers are in the geocode cache)
+    if failed_batches:
+        printv(f"[WARNING] {failed_batches} of {len(way_batches)} Overpass batches failed, {output_file} is not written",
+               verbose=True, color="red")
+    else:
+        house_polygons.to_csv(output_file, index=False)
+        printv(f"Saved data to {output_file}", verbose=verbose)
 
     return house_polygons
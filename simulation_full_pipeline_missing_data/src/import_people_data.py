@@ -10,106 +10,42 @@
 #########################################  
 
 import os
-import pickle
+import json
+import numpy as np
+import pandas as pd
+import numba as nb
 
-from helper import convert_lat_lon_to_sumo_coordinates, printv
-from collections import defaultdict
+from helper import get_lat_lon_to_sumo_converter, convert_sumo_coordinates_to_lat_lon, printv
 from config import GRID_BOTTOM, GRID_LEFT, GRID_RIGHT, GRID_TOP
 
+PEOPLE_CHUNK_SIZE = 500_000  # Rows of the people file processed at once
+
 
 
 #########################################
 # Functions
 #########################################  
 
-def get_people_data(file_data, file_sumo, recalculate=False, verbose=True):
+@nb.njit(parallel=True, cache=True)
+def _in_grid_mask(x, y, left, right, bottom, top):
     """
-    Get people data from the given file and filter it based on the specified coordinates.
-    If the data has been processed before with the same parameters, it is loaded from a cache file.
+    Check in a single parallel pass which coordinates lie inside the grid (borders included).
 
     Args:
-        file_data (str): Path to the input file.
-        file_sumo (str): Path to the SUMO network file.
-        recalculate (bool): If force recalculation of data even if cached data exists
-        verbose (bool): If more information should be printed.
+        x (numpy 1D array): SUMO x coordinates.
+        y (numpy 1D array): SUMO y coordinates.
+        left, right, bottom, top (float): Borders of the grid in the SUMO system.
 
     Returns:
-        dict: Dictionary with keys (x_coord, y_coord)->sumo system, and values as dictionaries containing:
-            - 'count': Number of people at this coordinate
-            - 'people': List of dictionaries containing people's attributes
+        numpy 1D array: Boolean mask, True if the coordinate is inside the grid.
     """
+    mask = np.empty(x.shape[0], dtype=np.bool_)
+    for i in nb.prange(x.shape[0]):
+        mask[i] = (left <= x[i] <= right) and (bottom <= y[i] <= top)
+    return mask
 
-    printv("Start function get_people_data", verbose=verbose, color="blue", decorate=True)
-
-    # Caching logic
-    cache_folder = "../output/temp/"
-    os.makedirs(cache_folder, exist_ok=True)
-    cache_filename = f"../output/temp/cached_people_data_{GRID_LEFT}_{GRID_RIGHT}_{GRID_BOTTOM}_{GRID_TOP}.pkl"
-
-    if os.path.exists(cache_filename) and not recalculate:
-        printv(f"[INFO] Loading cached people data from '{cache_filename}'...", verbose=verbose)
-        with open(cache_filename, 'rb') as f:
-            return pickle.load(f)
-
-
-    # Read data from the file
-    with open(file_data, 'r') as f:
-        data = f.readlines()[1:]  # skip header
-
-    n = len(data)
-    people_data = defaultdict(lambda: {"count": 0, "people": []})
-
-    printv("[INFO] Start of reading people... can take multiple minutes to an hour",
-           verbose=verbose)
-
-    # Read the data and filter based on coordinates -> increment people amount and add metadata about the person
-    counter = 0
-    last_percentage = 0
-    for line in data:
-        counter += 1
-        if verbose:
-            percentage = (counter / n) * 100
-            if percentage >= last_percentage:
-                printv(f"Scanned people: {last_percentage} %", verbose=verbose)
-                last_percentage += 10
-
-        parts = line.strip().split(',')
-
-        lat = float(parts[9])
-        lon = float(parts[10])
-
-        x_coord, y_coord = convert_lat_lon_to_sumo_coordinates(lat, lon, file_sumo)
-
-        if (GRID_LEFT <= x_coord <= GRID_RIGHT) and (GRID_BOTTOM <= y_coord <= GRID_TOP):
-            person_dict = {
-                "age": parts[0],
-                "level_of_employment": parts[1],
-                "household_income": parts[2],
-                "position_in_edu": parts[3],
-                "position_in_bus": parts[4],
-                "cars_drivetype": parts[5],
-                "public_transport": parts[6],
-                "has_car_and_licence": parts[11],
-                "x_coord": x_coord,
-                "y_coord": y_coord
-            }
-
-            coord_key = (x_coord, y_coord)
-            people_data[coord_key]["count"] += 1
-            people_data[coord_key]["people"].append(person_dict)
-
-    printv("End of reading people", verbose=verbose)
-
-    result = dict(people_data)
-
-    # Save to cache
-    with open(cache_filename, 'wb') as f:
-        pickle.dump(result, f)
-
-        printv(f"Saved processed people data to '{cache_filename}'", verbose=verbose)
-
-    return result
 
+def get_people_data(file_data, file_sumo, recalculate=False, verbose=True):
     """
     Get people data from the given file and filter it based on the specified coordinates.
     If the data has been processed before with the same parameters, it is loaded from a cache file.
@@ -117,81 +53,96 @@ def get_people_data(file_data, file_sumo, recalculate=False, verbose=True):
     Args:
         file_data (str): Path to the input file.
         file_sumo (str): Path to the SUMO network file.
-        recalculate (bool): Wehter to force recalculation of data
+        recalculate (bool): If force recalculation of data even if cached data exists
         verbose (bool): If more information should be printed.
 
     Returns:
-        dict: Dictionary with keys (x_coord, y_coord)->sumo system, and values as dictionaries containing:
-            - 'count': Number of people at this coordinate
-            - 'people': List of dictionaries containing people's attributes
+        dict: Columnar people data with the keys:
+            - 'people_df': DataFrame with one row per person (attributes, x_coord, y_coord and coord_id)
+            - 'coord_lookup': List of coordinates (x_coord, y_coord)->sumo system, indexed by coord_id
+            - 'counts': Dictionary coord_id -> number of people at this coordinate
     """
 
-    printv("Start function get_people_data",
-           verbose=verbose, color="blue", decorate=True)
+    printv("Start function get_people_data", verbose=verbose, color="blue", decorate=True)
 
+    # Caching logic
     cache_folder = "../output/temp/"
     os.makedirs(cache_folder, exist_ok=True)
-    cache_filename = f"../output/temp/cached_people_data_{GRID_LEFT1}_{GRID_RIGHT1}_{GRID_BOTTOM1}_{GRID_TOP1}.pkl"
+    cache_filename = f"../output/temp/cached_people_data_{GRID_LEFT}_{GRID_RIGHT}_{GRID_BOTTOM}_{GRID_TOP}.parquet"
+    cache_meta_filename = cache_filename.replace(".parquet", ".json")  # coord_lookup and counts
 
-    if os.path.exists(cache_filename) and not recalculate:
+    if os.path.exists(cache_filename) and os.path.exists(cache_meta_filename) and not recalculate:
         printv(f"[INFO] Loading cached people data from '{cache_filename}'...", verbose=verbose)
-        with open(cache_filename, 'rb') as f:
-            return pickle.load(f)
-
-    # Read data from the file
-    with open(file_data, 'r') as f:
-        data = f.readlines()[1:]  # skip header
-
-    n = len(data)
-    people_data = defaultdict(lambda: {"count": 0, "people": []})
-
-    printv("[INFO] Start of reading people... can take multiple minutes to an hour",
-           verbose=verbose)
-
-    counter = 0
-    last_percentage = 0
-    for line in data:
-        counter += 1
-        if verbose:
-            percentage = (counter / n) * 100
-            if percentage >= last_percentage:
-                printv(f"Scanned people: {last_percentage} %", verbose=verbose)
-                last_percentage += 10
-
-        parts = line.strip().split(',')
-
-        lat = float(parts[9])
-        lon = float(parts[10])
-
-        x_coord, y_coord = convert_lat_lon_to_sumo_coordinates(
-            lat, lon, file_sumo)
-
-        if (GRID_LEFT1 <= x_coord <= GRID_RIGHT1) and (GRID_BOTTOM1 <= y_coord <= GRID_TOP1):
-            person_dict = {
-                "age": parts[0],
-                "level_of_employment": parts[1],
-                "household_income": parts[2],
-                "position_in_edu": parts[3],
-                "position_in_bus": parts[4],
-                "cars_drivetype": parts[5],
-                "public_transport": parts[6],
-                "has_car_and_licence": parts[11],
-                "x_coord": x_coord,
-                "y_coord": y_coord
-            }
-
-            coord_key = (x_coord, y_coord)
-            people_data[coord_key]["count"] += 1
-            people_data[coord_key]["people"].append(person_dict)
+        with open(cache_meta_filename, 'r') as f:
+            meta = json.load(f)
+        return {
+            "people_df": pd.read_parquet(cache_filename),
+            "coord_lookup": [tuple(coord) for coord in meta["coord_lookup"]],
+            "counts": {int(coord_id): count for coord_id, count in meta["counts"].items()},
+        }
+
+
+    # Cheap prefilter on lat/lon: drop people outside the lat/lon envelope of the grid corners before projecting
+    # (small margin as the grid edges are not exactly lines of constant lat/lon, the exact filter follows below)
+    corners = [convert_sumo_coordinates_to_lat_lon(x, y, file_sumo) for x in (GRID_LEFT, GRID_RIGHT) for y in (GRID_BOTTOM, GRID_TOP)]
+    margin = 1e-3
+    min_lat, max_lat = min(lat for lat, _ in corners) - margin, max(lat for lat, _ in corners) + margin
+    min_lon, max_lon = min(lon for _, lon in corners) - margin, max(lon for _, lon in corners) + margin
+
+    lat_lon_to_sumo = get_lat_lon_to_sumo_converter(file_sumo)
+
+    # Stream the file in chunks (C parser, only the needed columns, empty fields stay empty strings) -> memory stays bounded by the chunk size
+    printv("[INFO] Start of reading people...", verbose=verbose)
+    person_columns = {0: "age", 1: "level_of_employment", 2: "household_income", 3: "position_in_edu", 4: "position_in_bus",
+                      5: "cars_drivetype", 6: "public_transport", 9: "lat", 10: "lon", 11: "has_car_and_licence"}
+    try:
+        reader = pd.read_csv(file_data, header=None, skiprows=1, usecols=list(person_columns), engine="c", na_filter=False,
+                             dtype={col: (np.float64 if name in ("lat", "lon") else str) for col, name in person_columns.items()},
+                             chunksize=PEOPLE_CHUNK_SIZE)
+    except pd.errors.EmptyDataError:
+        reader = []  # file without people (header only)
+
+    parts = []
+    scanned = 0
+    for chunk in reader:
+        scanned += len(chunk)
+        chunk = chunk.rename(columns=person_columns)
+        chunk = chunk.loc[chunk["lat"].between(min_lat, max_lat) & chunk["lon"].between(min_lon, max_lon)].copy()
+
+        # Convert to sumo coordinates and keep only the people on the grid
+        chunk["x_coord"], chunk["y_coord"] = lat_lon_to_sumo(chunk["lat"].values, chunk["lon"].values)
+        in_grid = _in_grid_mask(chunk["x_coord"].to_numpy(np.float64), chunk["y_coord"].to_numpy(np.float64),
+                                float(GRID_LEFT), float(GRID_RIGHT), float(GRID_BOTTOM), float(GRID_TOP))
+        parts.append(chunk.loc[in_grid].drop(columns=["lat", "lon"]))
+
+        printv(f"Scanned people: {scanned}", verbose=verbose)
+
+    if parts:
+        df = pd.concat(parts, ignore_index=True)
+    else:
+        # No people read -> empty frame with the same columns
+        df = pd.DataFrame({name: pd.Series(dtype=object) for name in person_columns.values() if name not in ("lat", "lon")})
+        df["x_coord"] = pd.Series(dtype=np.float64)
+        df["y_coord"] = pd.Series(dtype=np.float64)
+
+    # Columnar layout: every person gets the integer id of its coordinate instead of being grouped in per-coordinate lists
+    coord_ids, coord_index = pd.MultiIndex.from_arrays([df["x_coord"], df["y_coord"]]).factorize()
+    df["coord_id"] = coord_ids
 
     printv("End of reading people", verbose=verbose)
 
-    result = dict(people_data)
+    result = {
+        "people_df": df,
+        "coord_lookup": list(coord_index),
+        "counts": dict(enumerate(np.bincount(coord_ids, minlength=len(coord_index)).tolist())),
+    }
 
-    # Save to cache
-    with open(cache_filename, 'wb') as f:
-        pickle.dump(result, f)
+    # Save to cache (columnar parquet for the people, small json sidecar for the rest)
+    df.to_parquet(cache_filename, compression="zstd", index=False)
+    with open(cache_meta_filename, 'w') as f:
+        json.dump({"coord_lookup": [[float(x), float(y)] for x, y in result["coord_lookup"]],
+                   "counts": {int(coord_id): int(count) for coord_id, count in result["counts"].items()}}, f)
 
-        printv(f"Saved processed people data to '{cache_filename}'", verbose=verbose)
+    printv(f"Saved processed people data to '{cache_filename}'", verbose=verbose)
 
-    return result
\ No newline at end of file
+    return result
@@ -9,18 +9,20 @@
 # Imports
 #########################################  
 
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use("Agg")  # no display needed
+from matplotlib.figure import Figure
 import re
 from matplotlib.patches import Polygon as MplPolygon
-import ast
 import numpy as np
-import pandas as pd
 
-from helper import printv, array_to_csv, convert_lat_lon_to_sumo_coordinates, convert_sumo_coordinates_to_grid_x_y
+from helper import printv, array_to_csv, load_grid, map_in_threads, get_lat_lon_to_sumo_converter, convert_sumo_coordinates_to_grid_x_y
 import os
 import glob
 from config import NETWORK_FILE, GRID_LEFT, GRID_RIGHT, GRID_BOTTOM, GRID_TOP
 
+# Coordinate pairs "lon lat" in a WKT polygon, compiled once
+WKT_COORD_RE = re.compile(r'(\d+\.\d+)\s+(\d+\.\d+)')
 
 
 #########################################
@@ -55,45 +57,58 @@ def plot_heatmap(input_vec, house_polygons_df, name, verbose=False, log=True, pr
     # Option to make it logarithmic
     if log == True:
         input_vec = np.log(input_vec)
-        input_vec[input_vec < 0] = 0
+        np.maximum(input_vec, 0, out=input_vec)  # cutoff at zero in place (NaN stays NaN)
 
     # min-max normalization support
     if min_max:
         min_val = np.nanmin(input_vec)
         max_val = np.nanmax(input_vec)
         if max_val > min_val:
-            input_vec = (input_vec - min_val) / (max_val - min_val)
+            if log == True:
+                # Array is our own copy from np.log -> normalize in place instead of allocating two temporaries
+                input_vec -= min_val
+                input_vec /= (max_val - min_val)
+            else:
+                input_vec = (input_vec - min_val) / (max_val - min_val)
         else:
             input_vec = np.zeros_like(input_vec)
             printv("Min and max are equal. Input was constant or empty. (error from plot_heatmap function with min_max true)", verbose=True, color="Red")
 
-    # Start matplotlib stuff
-    plt.figure(figsize=(10, 8))
+    # Start matplotlib stuff (Figure instead of pyplot, pyplot's global state is not thread safe)
+    fig = Figure(figsize=(10, 8))
+    ax = fig.subplots()
 
-    hm = plt.imshow(input_vec.T, cmap='hot', interpolation='nearest', extent=[GRID_LEFT, GRID_RIGHT, GRID_BOTTOM, GRID_TOP], origin='lower')
-    plt.colorbar(label=f'{name}')
-    plt.title(f'{name} Heatmap')
-    plt.xlabel('Longitude')
-    plt.ylabel('Latitude')
-    plt.xlim(GRID_LEFT, GRID_RIGHT)
-    plt.ylim(GRID_BOTTOM, GRID_TOP)
+    hm = ax.imshow(input_vec.T, cmap='hot', interpolation='nearest', extent=[GRID_LEFT, GRID_RIGHT, GRID_BOTTOM, GRID_TOP], origin='lower')
+    fig.colorbar(hm, ax=ax, label=f'{name}')
+    ax.set_title(f'{name} Heatmap')
+    ax.set_xlabel('Longitude')
+    ax.set_ylabel('Latitude')
+    ax.set_xlim(GRID_LEFT, GRID_RIGHT)
+    ax.set_ylim(GRID_BOTTOM, GRID_TOP)
 
     hm_colors = hm.cmap(hm.norm(hm.get_array()))
 
     printv("Creaded plt and extracted colors", verbose=verbose)
 
     if print_house == True:
-        ax = plt.gca()
-        for i, row in house_polygons_df.iterrows():
+        # Read the projection of the network once for all houses
+        lat_lon_to_sumo = get_lat_lon_to_sumo_converter(NETWORK_FILE)
+
+        # Only houses with a polygon or a bounding box can be drawn, skip the rest before the loop
+        has_polygon = house_polygons_df['polygon'].astype("string").str.strip().str.startswith("POLYGON(", na=False)
+        has_bbox = house_polygons_df['bounding_box'].map(lambda bbox: isinstance(bbox, str))
+        houses_to_draw = house_polygons_df[has_polygon | has_bbox]
+
+        for row in houses_to_draw.itertuples():
+            i = row.Index
             try:
-                poly_wkt = row.get('polygon')
-                bbox = row.get('bounding_box')
+                poly_wkt = getattr(row, 'polygon', None)
+                bbox = getattr(row, 'bounding_box', None)
 
-                house_lat = row.get('lat')
-                house_lon = row.get('lon')
+                house_lat = getattr(row, 'lat', None)
+                house_lon = getattr(row, 'lon', None)
 
-                house_x, house_y = convert_lat_lon_to_sumo_coordinates(
-                    house_lat, house_lon, NETWORK_FILE)
+                house_x, house_y = lat_lon_to_sumo(house_lat, house_lon)
 
                 house_grid_x, house_grid_y = convert_sumo_coordinates_to_grid_x_y(
                     grid_left=GRID_LEFT, grid_right=GRID_RIGHT, grid_bottom=GRID_BOTTOM, grid_top=GRID_TOP, size_x=grid_width, size_y=grid_height, sumo_x=house_x, sumo_y=house_y, verbose=False)
@@ -105,7 +120,7 @@ def plot_heatmap(input_vec, house_polygons_df, name, verbose=False, log=True, pr
 
                 # Case 1: Real polygon exists
                 if isinstance(poly_wkt, str) and poly_wkt.strip().startswith("POLYGON("):
-                    matches = re.findall(r'(\d+\.\d+)\s+(\d+\.\d+)', poly_wkt)
+                    matches = WKT_COORD_RE.findall(poly_wkt)
                     if matches:
                         coords = [(float(lon), float(lat))
                                   for lon, lat in matches]
@@ -113,8 +128,8 @@ def plot_heatmap(input_vec, house_polygons_df, name, verbose=False, log=True, pr
                 # Case 2: Fallback to bounding box rectangle
                 elif isinstance(bbox, str):
                     try:
-                        # safely parse stringified list
-                        bb = ast.literal_eval(bbox)
+                        # parse stringified list, e.g. "['46.1', '46.2', '8.5', '8.6']"
+                        bb = [value.strip(" '\"") for value in bbox.strip("[] ").split(",")]
                         min_lat, max_lat, min_lon, max_lon = map(float, bb)
                         coords = [
                             (min_lon, min_lat),
@@ -129,8 +144,8 @@ def plot_heatmap(input_vec, house_polygons_df, name, verbose=False, log=True, pr
 
                 # Plotting if coords were found
                 if coords:
-                    coords_sumo = [convert_lat_lon_to_sumo_coordinates(lat, lon, NETWORK_FILE)
-                                   for lon, lat in coords]
+                    lons, lats = zip(*coords)
+                    coords_sumo = np.column_stack(lat_lon_to_sumo(lats, lons))
                     if house_coloring == False:
                         poly_patch = MplPolygon(coords_sumo, closed=True, edgecolor='green',
                                                 facecolor="none", linewidth=1, alpha=1.0)
@@ -143,16 +158,48 @@ def plot_heatmap(input_vec, house_polygons_df, name, verbose=False, log=True, pr
                 printv(f"Error processing polygon at index {i}: {e}", color="Red")
                 continue
 
-    plt.grid(False)
-    plt.tight_layout()
-    plt.savefig(output_path+f'/{name}_heatmap.png')
-    plt.close()
+    ax.grid(False)
+    fig.tight_layout()
+    fig.savefig(output_path+f'/{name}_heatmap.png', pil_kwargs={"compress_level": 1})  # fast PNG encoding, bigger file
     printv("Finished the plot", verbose=verbose)
 
 
+def _plot_heatmap_file(args):
+    """
+    Plots the heatmap of a single CSV file (run in a worker thread of plot_all_heatmaps).
+
+    Args:
+        args (tuple): (csv_file, plot_folder, house_polygons, print_houses, verbose)
+    Outputs:
+        None (only saves to a file)
+    """
+
+    csv_file, plot_folder, house_polygons, print_houses, verbose = args
+    try:
+        # Get the base filename without extension
+        base_name = os.path.basename(csv_file).replace(".csv", "")
+        printv(f"Processing {base_name}", verbose=verbose)
+
+        # Read CSV into a numpy array
+        array_data = load_grid(csv_file)
+
+        # If file name starts with "data_", then normalize the data
+        plot_name_extension = None
+        if base_name.startswith("data_"):
+            # Normalize the data to mg/m³
+            plot_name_extension = "_mg_per_m3"
+
+        # Plot heatmap for this data file
+        plot_name = f"{base_name}{plot_name_extension if plot_name_extension else ''}"
+        plot_heatmap(array_data, house_polygons, plot_name, verbose=verbose, log=False, print_house=print_houses, output_path=plot_folder)
+
+    except Exception as e:
+        printv(f"Error processing {csv_file}: {e}", verbose=True, color="Red")
+
+
 def plot_all_heatmaps(data_folder, plot_folder, house_polygons, print_houses=False, verbose=False):
     """
-    Plots all heatmaps for the given data.
+    Plots all heatmaps for the given data (in parallel, the plots are independent).
     Args:
         data_folder (str): Where to find all the csv
         plot_folder (str): Where to save my stuff to
@@ -174,26 +221,6 @@ def plot_all_heatmaps(data_folder, plot_folder, house_polygons, print_houses=Fal
     csv_files = glob.glob(os.path.join(data_folder, "*.csv"))
     printv(f"Found {len(csv_files)} CSV files in {data_folder}", verbose=verbose)
 
-    # Process each CSV file
-    for csv_file in csv_files:
-        try:
-            # Get the base filename without extension
-            base_name = os.path.basename(csv_file).replace(".csv", "")
-            printv(f"Processing {base_name}", verbose=verbose)
-
-            # Read CSV into a DataFrame and convert to numpy array
-            df = pd.read_csv(csv_file)
-            array_data = df.values
-
-            # If file name starts with "data_", then normalize the data
-            plot_name_extension = None
-            if base_name.startswith("data_"):
-                # Normalize the data to mg/m³
-                plot_name_extension = "_mg_per_m3"
-
-            # Plot heatmap for this data file
-            plot_name = f"{base_name}{plot_name_extension if plot_name_extension else ''}"
-            plot_heatmap(array_data, house_polygons, plot_name, verbose=verbose, log=False, print_house=print_houses, output_path=plot_folder)
-
-        except Exception as e:
-            printv(f"Error processing {csv_file}: {e}", verbose=True, color="Red")
+    # Process the CSV files in parallel
+    tasks = [(csv_file, plot_folder, house_polygons, print_houses, verbose) for csv_file in csv_files]
+    map_in_threads(_plot_heatmap_file, tasks)
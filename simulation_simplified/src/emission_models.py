@@ -10,137 +10,392 @@
 #########################################  
 
 import numpy as np
+import functools
 import os
 import sys
 if 'SUMO_HOME' in os.environ:
     sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
 import traci
 import numba as nb
+from numba import cuda
 
-from config import GRID_LEFT, GRID_RIGHT, GRID_BOTTOM, GRID_TOP, GRID_DIM_X, GRID_DIM_Y, GRID_DIM_Z
+from config import GRID
 from helper import printv
 
+# Vehicle variables subscribed for every vehicle when it departs (see get_vehicle_ids in sumo_commands)
+EMISSION_VARIABLES = [
+    traci.constants.VAR_POSITION,
+    traci.constants.VAR_COEMISSION,
+    traci.constants.VAR_NOXEMISSION,
+    traci.constants.VAR_PMXEMISSION,
+    traci.constants.VAR_NOISEEMISSION
+]
+
 #########################################
-# Numba JIT Compilation -> optimize performance
+# Numba JIT Compilation -> optimize performance (cache=True stores the compiled kernels on disk, no recompilation on restart)
 #########################################  
 
-@nb.jit(nopython=True)
-def _process_diffusion(old_matrix, padded, dx2, dy2, dz2, diffusion, loss_rate, default_value, dt, V):
-    """Combined function that processes all diffusion steps in one optimized pass"""
-    x_dim, y_dim, z_dim = old_matrix.shape
-    
-    # Convert to concentration
-    for i in range(x_dim):
-        for j in range(y_dim):
-            for k in range(z_dim):
-                padded[i+1, j+1, k+1] = old_matrix[i, j, k] / V
-    
-    # Apply no-flux boundary at bottom
-    for i in range(padded.shape[0]):
-        for j in range(padded.shape[1]):
-            padded[i, j, 0] = padded[i, j, 1]
-    
-    # Calculate diffusion coefficients
-    diff_x = diffusion / dx2
-    diff_y = diffusion / dy2
-    diff_z = diffusion / dz2
-    
-    # Process diffusion and update in single pass to avoid extra array allocations
-    for i in range(x_dim):
+# Block size of the diffusion stencil in x- and y-direction (z is always processed whole)
+TILE_X = 8
+TILE_Y = 16
+
+@functools.lru_cache(maxsize=4)
+def _make_process_diffusion_all(coef_x, coef_y, coef_z, keep, floors):
+    """Create the fused diffusion kernel of CO, NOx and PMx with the constants of a simulation baked in as compile-time constants.
+    Per gas (CO, NOx, PMx) in mass per cell: coef_* = dt * diffusion / d*², keep = 1 - dt * loss_rate, floors = default_value * V"""
+
+    @nb.njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+    def _process_diffusion_all(co_matrix, nox_matrix, pmx_matrix, padded, x0, x1, y0, y1):
+        """Diffusion step of CO, NOx and PMx in one pass over the cells [x0, x1) x [y0, y1) (padded holds one ghost-celled grid of masses per gas)"""
+        x_dim, y_dim, z_dim = co_matrix.shape
+        
+        # Ghost cells on the sides and the top keep the default mass (split over the x-planes like the stencil, the top layer touches a cache line per cell)
+        for i in nb.prange(x_dim + 2):
+            for g in range(3):
+                floor = floors[g]
+                if i == 0 or i == x_dim + 1:
+                    for j in range(y_dim + 2):
+                        for k in range(z_dim + 2):
+                            padded[g, i, j, k] = floor
+                else:
+                    for k in range(z_dim + 2):
+                        padded[g, i, 0, k] = floor
+                        padded[g, i, y_dim+1, k] = floor
+                    for j in range(1, y_dim + 1):
+                        padded[g, i, j, z_dim+1] = floor
+        
+        # Copy the masses, apply no-flux boundary at bottom (ghost cell equals lowest cell), only the updated cells and their neighbours are needed
+        for i in nb.prange(max(x0 - 1, 0), min(x1 + 1, x_dim)):
+            for j in range(max(y0 - 1, 0), min(y1 + 1, y_dim)):
+                padded[0, i+1, j+1, 0] = co_matrix[i, j, 0]
+                padded[1, i+1, j+1, 0] = nox_matrix[i, j, 0]
+                padded[2, i+1, j+1, 0] = pmx_matrix[i, j, 0]
+                for k in range(z_dim):
+                    padded[0, i+1, j+1, k+1] = co_matrix[i, j, k]
+                    padded[1, i+1, j+1, k+1] = nox_matrix[i, j, k]
+                    padded[2, i+1, j+1, k+1] = pmx_matrix[i, j, k]
+        
+        # Process diffusion and update in single pass to avoid extra array allocations
+        # Walk the grid in (TILE_X, TILE_Y, z_dim) blocks so the neighbouring cells of a block stay in cache, z is contiguous in memory
+        n_tiles_x = (x1 - x0 + TILE_X - 1) // TILE_X
+        for tile in nb.prange(n_tiles_x):
+            i0 = x0 + tile * TILE_X
+            i1 = min(i0 + TILE_X, x1)
+            for j0 in range(y0, y1, TILE_Y):
+                j1 = min(j0 + TILE_Y, y1)
+                for i in range(i0, i1):
+                    for j in range(j0, j1):
+                        # CO, NOx and PMx get their own z sweep so each inner loop streams through a single contiguous column
+                        for k in range(z_dim):
+                            m = padded[0,i+1,j+1,k+1]
+                            value = (keep[0] * m +
+                                     coef_x[0] * (padded[0,i+2,j+1,k+1] + padded[0,i,j+1,k+1] - 2*m) +
+                                     coef_y[0] * (padded[0,i+1,j+2,k+1] + padded[0,i+1,j,k+1] - 2*m) +
+                                     coef_z[0] * (padded[0,i+1,j+1,k+2] + padded[0,i+1,j+1,k] - 2*m))
+                            if value < floors[0]:
+                                value = floors[0]
+                            co_matrix[i,j,k] = value
+                        for k in range(z_dim):
+                            m = padded[1,i+1,j+1,k+1]
+                            value = (keep[1] * m +
+                                     coef_x[1] * (padded[1,i+2,j+1,k+1] + padded[1,i,j+1,k+1] - 2*m) +
+                                     coef_y[1] * (padded[1,i+1,j+2,k+1] + padded[1,i+1,j,k+1] - 2*m) +
+                                     coef_z[1] * (padded[1,i+1,j+1,k+2] + padded[1,i+1,j+1,k] - 2*m))
+                            if value < floors[1]:
+                                value = floors[1]
+                            nox_matrix[i,j,k] = value
+                        for k in range(z_dim):
+                            m = padded[2,i+1,j+1,k+1]
+                            value = (keep[2] * m +
+                                     coef_x[2] * (padded[2,i+2,j+1,k+1] + padded[2,i,j+1,k+1] - 2*m) +
+                                     coef_y[2] * (padded[2,i+1,j+2,k+1] + padded[2,i+1,j,k+1] - 2*m) +
+                                     coef_z[2] * (padded[2,i+1,j+1,k+2] + padded[2,i+1,j+1,k] - 2*m))
+                            if value < floors[2]:
+                                value = floors[2]
+                            pmx_matrix[i,j,k] = value
+
+    return _process_diffusion_all
+
+@nb.njit(parallel=True, cache=True)
+def accumulate_noise_exposure(noise_grid, thresholds, exposure):
+    """Add one second to the exposure counters (exposure[t] belongs to thresholds[t]) of every cell at or above the thresholds, in a single pass over the noise grid"""
+    x_dim, y_dim = noise_grid.shape
+    for i in nb.prange(x_dim):
         for j in range(y_dim):
-            for k in range(z_dim):
-                # Calculate diffusion change
-                diff_change = (
-                    diff_x * (padded[i+2,j+1,k+1] + padded[i,j+1,k+1] - 2*padded[i+1,j+1,k+1]) +
-                    diff_y * (padded[i+1,j+2,k+1] + padded[i+1,j,k+1] - 2*padded[i+1,j+1,k+1]) +
-                    diff_z * (padded[i+1,j+1,k+2] + padded[i+1,j+1,k] - 2*padded[i+1,j+1,k+1])
-                )
-                
-                # Apply change directly to the matrix
-                old_matrix[i,j,k] += dt * V * diff_change - dt * loss_rate * old_matrix[i,j,k]
-                
-                # Ensure no value below default
-                if old_matrix[i,j,k] < default_value * V:
-                    old_matrix[i,j,k] = default_value * V
-    
-    return old_matrix
+            noise = noise_grid[i, j]
+            for t in range(thresholds.size):
+                exposure[t, i, j] += noise >= thresholds[t]
+
+@nb.njit(parallel=True, boundscheck=False, cache=True)
+def _add_noise_sources(linear_matrix, x_vec, y_vec, noise_vec, cell_len_x_m, cell_len_y_m, radius, background_dB, grid_left, grid_bottom, inv_cell_dim_x, inv_cell_dim_y):
+    """Add the spherically spread intensity of every noise source within the radius to the linear (intensity) matrix.
+    Parallel over the x rows, every cell adds the sources in their order (same sums as one source after the other)"""
+    x_dim, y_dim = linear_matrix.shape
+    n = x_vec.size
+
+    # Grid cell and power (linear scale, at least the background) of every source
+    x_idx = np.empty(n, dtype=np.int64)
+    y_idx = np.empty(n, dtype=np.int64)
+    inside = np.zeros(n, dtype=np.bool_)
+    power_linear = np.empty(n)
+    for v in range(n):
+        x_idx[v] = int((x_vec[v] - grid_left) * inv_cell_dim_x)
+        y_idx[v] = int((y_vec[v] - grid_bottom) * inv_cell_dim_y)
+        inside[v] = 0 <= x_idx[v] < x_dim and 0 <= y_idx[v] < y_dim
+        power_linear[v] = 10.0 ** (max(noise_vec[v], background_dB) / 10.0)
+
+    # Bounding box of the radius in cells
+    reach_x = int(radius / cell_len_x_m)
+    reach_y = int(radius / cell_len_y_m)
+    radius_squared = radius * radius
+
+    for i in nb.prange(x_dim):
+        for v in range(n):
+            if not inside[v] or abs(i - x_idx[v]) > reach_x:
+                continue
+            dx = (i - x_idx[v]) * cell_len_x_m
+            for j in range(max(0, y_idx[v] - reach_y), min(y_dim, y_idx[v] + reach_y + 1)):
+                dy = (j - y_idx[v]) * cell_len_y_m
+                dist_squared_m = dx * dx + dy * dy
+                if dist_squared_m <= radius_squared:
+                    # Spherical spreading: intensity / (4πr²), 1m minimum distance
+                    linear_matrix[i, j] += power_linear[v] / (4 * np.pi * max(dist_squared_m, 1.0))
+
+def _make_add_emissions(grid):
+    """Create the emission kernel with the grid constants of the village (GridSpec) baked in as compile-time constants"""
+    grid_left, grid_bottom, inv_cell_dim_x, inv_cell_dim_y = grid.left, grid.bottom, grid.invdx, grid.invdy
+    grid_dim_x, grid_dim_y = grid.nx, grid.ny
+
+    @nb.njit(fastmath=True, boundscheck=False, cache=True)
+    def _add_emissions_all(co_matrix, nox_matrix, pmx_matrix, x_vec, y_vec, co_em, nox_em, pmx_em, active_box):
+        """Convert SUMO coordinates to grid indices and add the emissions of all three gases (grid index computed once per vehicle). Grows active_box [x0, x1, y0, y1) to the emitting cells"""
+        for i in range(x_vec.size):
+            x_idx = int((x_vec[i] - grid_left) * inv_cell_dim_x)
+            y_idx = int((y_vec[i] - grid_bottom) * inv_cell_dim_y)
+            if 0 <= x_idx < grid_dim_x and 0 <= y_idx < grid_dim_y:
+                co_matrix[x_idx, y_idx, 0] += co_em[i]
+                nox_matrix[x_idx, y_idx, 0] += nox_em[i]
+                pmx_matrix[x_idx, y_idx, 0] += pmx_em[i]
+                active_box[0] = min(active_box[0], x_idx)
+                active_box[1] = max(active_box[1], x_idx + 1)
+                active_box[2] = min(active_box[2], y_idx)
+                active_box[3] = max(active_box[3], y_idx + 1)
+
+    return _add_emissions_all
+
 
-@nb.jit(nopython=True)
-def _add_emissions(old_matrix, x_indices, y_indices, emissions, grid_dim_x, grid_dim_y):
-    """Add emissions to the matrix efficiently"""
-    for i in range(len(x_indices)):
-        x_idx = x_indices[i]
-        y_idx = y_indices[i]
-        if 0 <= x_idx < grid_dim_x and 0 <= y_idx < grid_dim_y:
-            old_matrix[x_idx, y_idx, 0] += emissions[i]
-    return old_matrix
+# Specialize once for the grid of the configured village
+_add_emissions_all = _make_add_emissions(GRID)
+
+
+#########################################
+# CUDA kernels -> optional GPU version of the gas step (compiled on first use, only if a GPU is used)
+#########################################  
+
+GPU_AVAILABLE = cuda.is_available()
+
+# Threads per block in (z, y, x) -> consecutive threads work on consecutive z cells (contiguous in memory)
+CUDA_BLOCK = (32, 4, 2)
+
+@cuda.jit
+def _diffusion_all_cuda(grids, grids_next, coefficients, dt, V):
+    """Same stencil and boundaries as _process_diffusion_all for the (gas, x, y, z) grids, one thread per cell, writes into grids_next.
+    coefficients[:, g] = (diff_x, diff_y, diff_z, loss rate, default value) of gas g"""
+    k, j, i = cuda.grid(3)
+    n_gas, x_dim, y_dim, z_dim = grids.shape
+    if i >= x_dim or j >= y_dim or k >= z_dim:
+        return
+    for g in range(n_gas):
+        default_value = coefficients[4, g]
+        c = grids[g, i, j, k] / V
+        # Ghost cells on the sides and the top keep the default concentration, no-flux boundary at the bottom
+        c_xp = grids[g, i+1, j, k] / V if i + 1 < x_dim else default_value
+        c_xm = grids[g, i-1, j, k] / V if i > 0 else default_value
+        c_yp = grids[g, i, j+1, k] / V if j + 1 < y_dim else default_value
+        c_ym = grids[g, i, j-1, k] / V if j > 0 else default_value
+        c_zp = grids[g, i, j, k+1] / V if k + 1 < z_dim else default_value
+        c_zm = grids[g, i, j, k-1] / V if k > 0 else c
+        diff_change = (
+            coefficients[0, g] * (c_xp + c_xm - 2*c) +
+            coefficients[1, g] * (c_yp + c_ym - 2*c) +
+            coefficients[2, g] * (c_zp + c_zm - 2*c)
+        )
+        value = grids[g, i, j, k] + dt * V * diff_change - dt * coefficients[3, g] * grids[g, i, j, k]
+        grids_next[g, i, j, k] = max(value, default_value * V)
+
+@cuda.jit
+def _add_emissions_all_cuda(grids, x_idx, y_idx, emissions):
+    """Add the (gas, vehicle) emissions at the grid cells of the vehicles, atomic as several vehicles can share a cell"""
+    v = cuda.grid(1)
+    if v < x_idx.size:
+        for g in range(emissions.shape[0]):
+            cuda.atomic.add(grids, (g, x_idx[v], y_idx[v], 0), emissions[g, v])
 
 
 #########################################
 # Preallocate padded concentration matrix
 #########################################  
 
-padded_shape = (GRID_DIM_X + 2, GRID_DIM_Y + 2, GRID_DIM_Z + 2)
-padded_concentration = np.zeros(padded_shape)
+padded_shape = (GRID.nx + 2, GRID.ny + 2, GRID.nz + 2)
+padded_concentration_all = np.zeros((3,) + padded_shape)  # one padded grid of masses per gas for the gas step
 
 
 #########################################
 # Functions
 #########################################  
 
-def process_gas_step(old_matrix, x_vec, y_vec, emission_vec, cell_len_x_m, cell_len_y_m, cell_len_z_m, default_value, diffusion, loss_rate=0, verbose=False, dt=1):
+def make_gas_stepper(cell_len_x_m, cell_len_y_m, cell_len_z_m, default_values, diffusions, loss_rates, dt):
+    """
+    Binds the constants of a simulation (cell size, gas properties, time step) once, for the many calls of the main loop.
+    The returned step processes the emissions and the diffusion of CO, NOx and PMx at once, the grid is traversed once per step for all gases.
+    With an active_box only the part of the grid that differs from the default values is diffused:
+    outside of it every cell and its neighbours are at the default value, which the stencil leaves unchanged.
+    Args:
+        cell_len_x_m, cell_len_y_m, cell_len_z_m (float): Real size of the grid cells [m]
+        default_values (1D array): Default concentration of (CO, NOx, PMx)
+        diffusions (1D array): Diffusion coefficients of (CO, NOx, PMx) [m²/s]
+        loss_rates (1D array): Loss rate coefficients of (CO, NOx, PMx) [1/s]
+        dt (float): Time step length [seconds]
+    Returns:
+        function: step(co_matrix, nox_matrix, pmx_matrix, x_vec, y_vec, co_vec, nox_vec, pmx_vec, active_box=None) -> updated
+            (co_matrix, nox_matrix, pmx_matrix). The gas matrices are updated in place, x_vec/y_vec are the positions of the new
+            emissions in SUMO coords and co_vec/nox_vec/pmx_vec their values. active_box (1D int array) is [x0, x1, y0, y1) of the
+            cells that are not at the default values (see find_active_box), updated in place (grows with the emissions and by one
+            cell per step). None processes the whole grid
+    """
+    V = cell_len_x_m * cell_len_y_m * cell_len_z_m  # m³
+
+    # Cell dimensions squared for diffusion calculation
+    dx2 = cell_len_x_m * cell_len_x_m
+    dy2 = cell_len_y_m * cell_len_y_m
+    dz2 = cell_len_z_m * cell_len_z_m
+
+    # Diffusion kernel specialized for these constants (dt, cell size and gas properties are fixed for a simulation)
+    diffusions = np.asarray(diffusions, dtype=np.float64)
+    _process_diffusion_all = _make_process_diffusion_all(
+        tuple((dt * diffusions / dx2).tolist()), tuple((dt * diffusions / dy2).tolist()), tuple((dt * diffusions / dz2).tolist()),
+        tuple((1 - dt * np.asarray(loss_rates, dtype=np.float64)).tolist()), tuple((np.asarray(default_values, dtype=np.float64) * V).tolist()))
+
+    def step(co_matrix, nox_matrix, pmx_matrix, x_vec, y_vec, co_vec, nox_vec, pmx_vec, active_box=None):
+        x_dim, y_dim, _ = co_matrix.shape
+        if active_box is None:
+            box = np.array([0, x_dim, 0, y_dim])
+        else:
+            box = active_box
+
+        # Add new emissions if available
+        if len(x_vec) > 0:
+            _add_emissions_all(co_matrix, nox_matrix, pmx_matrix,
+                               np.asarray(x_vec, dtype=np.float64), np.asarray(y_vec, dtype=np.float64),
+                               np.asarray(co_vec, dtype=np.float64), np.asarray(nox_vec, dtype=np.float64), np.asarray(pmx_vec, dtype=np.float64), box)
+
+        # Nothing differs from the default values -> the step changes nothing
+        if box[0] >= box[1] or box[2] >= box[3]:
+            return co_matrix, nox_matrix, pmx_matrix
+
+        # The stencil reaches one cell further per step
+        box[0] = max(box[0] - 1, 0)
+        box[1] = min(box[1] + 1, x_dim)
+        box[2] = max(box[2] - 1, 0)
+        box[3] = min(box[3] + 1, y_dim)
+
+        # Diffusion of all gases in one pass (padded arrays are preallocated, the kernel sets their boundaries)
+        _process_diffusion_all(co_matrix, nox_matrix, pmx_matrix, padded_concentration_all, box[0], box[1], box[2], box[3])
+
+        return co_matrix, nox_matrix, pmx_matrix
+
+    return step
+
+
+def find_active_box(co_matrix, nox_matrix, pmx_matrix, default_values, cell_len_x_m, cell_len_y_m, cell_len_z_m):
     """
-    Processes a single step of gas emissions and diffusion in the grid.
+    Finds the bounding box of the cells that are not at the default value of their gas (for the active_box of the step of make_gas_stepper).
     Args:
-        old_matrix (3D numpy array): Current gas concentration matrix
+        co_matrix, nox_matrix, pmx_matrix (3D numpy arrays): Current gas matrices [mg per cell]
+        default_values (1D array): Default concentration of (CO, NOx, PMx)
+        cell_len_x_m, cell_len_y_m, cell_len_z_m (float): Real size of the grid cells [m]
+    Returns:
+        1D int array: [x0, x1, y0, y1) of the active cells, empty (x0 >= x1) if all cells are at the default values
+    """
+    V = cell_len_x_m * cell_len_y_m * cell_len_z_m  # m³
+    active = ((co_matrix != default_values[0] * V) | (nox_matrix != default_values[1] * V) | (pmx_matrix != default_values[2] * V)).any(axis=2)
+    xs = np.flatnonzero(active.any(axis=1))
+    ys = np.flatnonzero(active.any(axis=0))
+    if xs.size == 0:
+        return np.array([active.shape[0], 0, active.shape[1], 0])
+    return np.array([xs[0], xs[-1] + 1, ys[0], ys[-1] + 1])
+
+
+def gases_to_device(co_matrix, nox_matrix, pmx_matrix):
+    """
+    Copies the gas matrices to the GPU for step_all_gases_cuda, where they stay for the whole simulation.
+    Args:
+        co_matrix, nox_matrix, pmx_matrix (3D numpy arrays): Gas matrices [mg per cell]
+    Returns:
+        tuple: (grids, grids_next) device arrays (gas, x, y, z), the second one is the output buffer of the next step
+    """
+    grids = cuda.to_device(np.stack([co_matrix, nox_matrix, pmx_matrix]))
+    grids_next = cuda.device_array_like(grids)
+    return grids, grids_next
+
+
+def gases_to_host(grids):
+    """
+    Copies the gas matrices back from the GPU (for the screenshots).
+    Args:
+        grids (device array): (gas, x, y, z) grids from gases_to_device / step_all_gases_cuda
+    Returns:
+        tuple: (co_matrix, nox_matrix, pmx_matrix) numpy 3D arrays
+    """
+    host = grids.copy_to_host()
+    return host[0], host[1], host[2]
+
+
+def step_all_gases_cuda(grids, grids_next, x_vec, y_vec, co_vec, nox_vec, pmx_vec, cell_len_x_m, cell_len_y_m, cell_len_z_m, default_values, diffusions, loss_rates, verbose=False, dt=1):
+    """
+    GPU version of the step of make_gas_stepper, the grids stay on the device (see gases_to_device).
+    Args:
+        grids (device array): Current (gas, x, y, z) grids of CO, NOx and PMx [mg per cell], emissions are added in place
+        grids_next (device array): Buffer of the same shape for the result
         x_vec (1D array): x positions of the new emissions in SUMO coords
         y_vec (1D array): y positions of the new emissions in SUMO coords
-        emission_vec (1D array): Emission values at the corresponding positions
+        co_vec, nox_vec, pmx_vec (1D arrays): Emission values at the corresponding positions
         cell_len_x_m (float): Real size of the grid cells in x-direction [m]
         cell_len_y_m (float): Real size of the grid cells in y-direction [m]
         cell_len_z_m (float): Real size of the grid cells in z-direction [m]
-        default_value (float): Default value for gas concentration
-        diffusion (float): Diffusion coefficient [m²/s]
-        loss_rate (float): Loss rate coefficient [1/s]
+        default_values (1D array): Default concentration of (CO, NOx, PMx)
+        diffusions (1D array): Diffusion coefficients of (CO, NOx, PMx) [m²/s]
+        loss_rates (1D array): Loss rate coefficients of (CO, NOx, PMx) [1/s]
         verbose (bool): If more information should be printed.
         dt (float): Time step length [seconds]
     Returns:
-        3D numpy array: Updated gas concentration matrix after processing emissions and diffusion
+        tuple: (grids, grids_next) swapped -> the updated grids first, the free buffer second
     """
-    printv("Start function process_gas_step", verbose=verbose)
+    printv("Start function step_all_gases_cuda", verbose=verbose)
 
     V = cell_len_x_m * cell_len_y_m * cell_len_z_m  # m³
+    _, x_dim, y_dim, z_dim = grids.shape
 
-    # Size of each cell in the grid in SUMO coordinates
-    cell_dim_x = (GRID_RIGHT - GRID_LEFT) / GRID_DIM_X
-    cell_dim_y = (GRID_TOP - GRID_BOTTOM) / GRID_DIM_Y
-
-    # Add new emissions if available
+    # Add new emissions if available (grid indices on the CPU, only the vehicles inside the grid are copied over)
     if len(x_vec) > 0:
-        # Convert to numpy arrays and calculate indices
-        x_vec_array = np.array(x_vec, dtype=np.float64)
-        y_vec_array = np.array(y_vec, dtype=np.float64)
-        emission_vec_array = np.array(emission_vec, dtype=np.float64)
-        
-        # Convert SUMO coordinates to grid indices
-        x_indices = ((x_vec_array - GRID_LEFT) / cell_dim_x).astype(np.int32)
-        y_indices = ((y_vec_array - GRID_BOTTOM) / cell_dim_y).astype(np.int32)
-        
-        old_matrix = _add_emissions(old_matrix, x_indices, y_indices, emission_vec_array, GRID_DIM_X, GRID_DIM_Y)
-    
-    # Cell dimensions squared for diffusion calculation
-    dx2 = cell_len_x_m * cell_len_x_m
-    dy2 = cell_len_y_m * cell_len_y_m
-    dz2 = cell_len_z_m * cell_len_z_m
+        x_idx = ((np.asarray(x_vec, dtype=np.float64) - GRID.left) * GRID.invdx).astype(np.int64)
+        y_idx = ((np.asarray(y_vec, dtype=np.float64) - GRID.bottom) * GRID.invdy).astype(np.int64)
+        inside = (x_idx >= 0) & (x_idx < x_dim) & (y_idx >= 0) & (y_idx < y_dim)
+        if inside.any():
+            emissions = np.stack([co_vec, nox_vec, pmx_vec]).astype(np.float64)[:, inside]
+            n_inside = int(inside.sum())
+            _add_emissions_all_cuda[(n_inside + 127) // 128, 128](
+                grids, cuda.to_device(x_idx[inside]), cuda.to_device(y_idx[inside]), cuda.to_device(emissions))
 
-    # Reset padded array (preallocated for performance)
-    global padded_concentration
-    padded_concentration.fill(default_value)
-    
-    # Process diffusion in a single optimized step
-    old_matrix = _process_diffusion(old_matrix, padded_concentration, dx2, dy2, dz2, diffusion, loss_rate, default_value, dt, V)
-    
-    return old_matrix
+    # Diffusion of all gases, one thread per cell (the per gas constants go over in a single small copy)
+    coefficients = np.stack([diffusions / (cell_len_x_m * cell_len_x_m), diffusions / (cell_len_y_m * cell_len_y_m),
+                             diffusions / (cell_len_z_m * cell_len_z_m), loss_rates, default_values]).astype(np.float64)
+    blocks = ((z_dim + CUDA_BLOCK[0] - 1) // CUDA_BLOCK[0],
+              (y_dim + CUDA_BLOCK[1] - 1) // CUDA_BLOCK[1],
+              (x_dim + CUDA_BLOCK[2] - 1) // CUDA_BLOCK[2])
+    _diffusion_all_cuda[blocks, CUDA_BLOCK](grids, grids_next, cuda.to_device(coefficients), dt, V)
+
+    return grids_next, grids
 
 
 def process_noise(x_vec, y_vec, noise_vec, cell_len_x_m, cell_len_y_m, radius=500, background_dB=30, verbose=False):
@@ -161,56 +416,16 @@ def process_noise(x_vec, y_vec, noise_vec, cell_len_x_m, cell_len_y_m, radius=50
     """
     printv("Start function process_noise", verbose=verbose)
     
-    # Calculate cell dimensions for coordinate conversion
-    cell_dim_x = (GRID_RIGHT - GRID_LEFT) / GRID_DIM_X
-    cell_dim_y = (GRID_TOP - GRID_BOTTOM) / GRID_DIM_Y
-
     # Initialize with background noise (in linear scale)
     background_linear = 10 ** (background_dB/10)
-    linear_matrix = np.ones((GRID_DIM_X, GRID_DIM_Y)) * background_linear
+    linear_matrix = np.ones((GRID.nx, GRID.ny)) * background_linear
     
-    printv(f"Grid dimensions: {GRID_DIM_X}x{GRID_DIM_Y}, Cell sizes: {cell_len_x_m}m x {cell_len_y_m}m", verbose=verbose)
+    printv(f"Grid dimensions: {GRID.nx}x{GRID.ny}, Cell sizes: {cell_len_x_m}m x {cell_len_y_m}m", verbose=verbose)
     
-    # Process each noise source
-    for i in range(len(x_vec)):
-        # Convert SUMO coordinates to grid indices
-        x_idx = int((x_vec[i] - GRID_LEFT) / cell_dim_x)
-        y_idx = int((y_vec[i] - GRID_BOTTOM) / cell_dim_y)
-        
-        # Skip if outside grid
-        if not (0 <= x_idx < GRID_DIM_X and 0 <= y_idx < GRID_DIM_Y):
-            continue
-            
-        # Get source power level - make sure it's above background
-        Lw = max(noise_vec[i], background_dB) 
-        
-        # Find the cells within the radius for better performance -> create a bounding box
-        x_min = max(0, x_idx - int(radius / cell_len_x_m))
-        x_max = min(GRID_DIM_X, x_idx + int(radius / cell_len_x_m) + 1)
-        y_min = max(0, y_idx - int(radius / cell_len_y_m))
-        y_max = min(GRID_DIM_Y, y_idx + int(radius / cell_len_y_m) + 1)
-        
-        # Process only cells within the bounding box
-        for x in range(x_min, x_max):
-            for y in range(y_min, y_max):
-                # Calculate distance squared in physical meters
-                dx = (x - x_idx) * cell_len_x_m
-                dy = (y - y_idx) * cell_len_y_m
-                dist_squared_m = dx*dx + dy*dy
-                
-                # Skip if outside radius
-                if dist_squared_m > radius*radius:
-                    continue
-                    
-                # Surface area for spherical propagation (S = 4πr²)
-                S = 4 * np.pi * max(dist_squared_m, 1.0)  # 1m minimum distance
-                
-                # Apply spherical spreading law: Lp = Lw - 10*log10(S)
-                Lp = Lw - 10 * np.log10(S)
-                
-                # Convert to linear scale and add contribution
-                linear_contribution = 10 ** (Lp/10)
-                linear_matrix[x, y] += linear_contribution
+    # Add the contribution of every noise source within its radius (spherical spreading law Lp = Lw - 10*log10(4πr²), summed in linear scale)
+    if len(x_vec) > 0:
+        _add_noise_sources(linear_matrix, np.asarray(x_vec, dtype=np.float64), np.asarray(y_vec, dtype=np.float64), np.asarray(noise_vec, dtype=np.float64),
+                           float(cell_len_x_m), float(cell_len_y_m), float(radius), float(background_dB), GRID.left, GRID.bottom, GRID.invdx, GRID.invdy)
     
     # Convert back to dB scale using logarithmic formula
     result = 10 * np.log10(linear_matrix)
@@ -249,49 +464,46 @@ def calculate_optimal_dt(cell_len_x_m, cell_len_y_m, cell_len_z_m, diffusion, lo
 
 
 def get_emissions_batched(vehicle_ids, dt, verbose=False):
-    """Get all vehicle data in a single batch using subscriptions
+    """Get all vehicle data in a single batch using persistent subscriptions
+    (the vehicles are subscribed to EMISSION_VARIABLES by get_vehicle_ids when they depart)
     
     Args:
         vehicle_ids (list): List of vehicle IDs to retrieve data for
         dt (float): Time step length [s]
         verbose (bool): If more information should be printed.
     Returns:
-        tuple: Lists of x, y positions and emissions (CO, NOx, PMx, noise)
+        tuple: Numpy arrays of x, y positions and emissions (CO, NOx, PMx, noise)
     
     """
 
     printv("Start function get_emissions_batched", verbose=verbose, decorate=True)
 
-    # Data containers
-    x_vec = []
-    y_vec = []
-    co_vec = []
-    nox_vec = []
-    pmx_vec = []
-    noise_vec = []
-    
-    # Set up subscription for all vehicles at once
-    for vehicle_id in vehicle_ids:
-        traci.vehicle.subscribe(vehicle_id, [
-            traci.constants.VAR_POSITION,
-            traci.constants.VAR_COEMISSION,
-            traci.constants.VAR_NOXEMISSION,
-            traci.constants.VAR_PMXEMISSION,
-            traci.constants.VAR_NOISEEMISSION
-        ])
+    # Data containers (preallocated, shrunk to the vehicles with results at the end)
+    n = len(vehicle_ids)
+    x_vec = np.empty(n, dtype=np.float64)
+    y_vec = np.empty(n, dtype=np.float64)
+    co_vec = np.empty(n, dtype=np.float64)
+    nox_vec = np.empty(n, dtype=np.float64)
+    pmx_vec = np.empty(n, dtype=np.float64)
+    noise_vec = np.empty(n, dtype=np.float64)
+    valid = np.zeros(n, dtype=bool)
     
-    # Retrieve all data with one socket call per vehicle (instead of 5)
-    for vehicle_id in vehicle_ids:
-        result = traci.vehicle.getSubscriptionResults(vehicle_id)
-        if result is None:  # Handle potential None result
+    # Results of all subscribed vehicles arrive with the simulation step, no extra socket call per vehicle
+    results = traci.vehicle.getAllSubscriptionResults()
+    for i, vehicle_id in enumerate(vehicle_ids):
+        result = results.get(vehicle_id)
+        if not result:  # Handle potential missing result
             continue
             
         position = result[traci.constants.VAR_POSITION]
-        x_vec.append(position[0])
-        y_vec.append(position[1])
-        co_vec.append(result[traci.constants.VAR_COEMISSION] * dt)
-        nox_vec.append(result[traci.constants.VAR_NOXEMISSION] * dt)
-        pmx_vec.append(result[traci.constants.VAR_PMXEMISSION] * dt)
-        noise_vec.append(result[traci.constants.VAR_NOISEEMISSION])
+        x_vec[i] = position[0]
+        y_vec[i] = position[1]
+        co_vec[i] = result[traci.constants.VAR_COEMISSION] * dt
+        nox_vec[i] = result[traci.constants.VAR_NOXEMISSION] * dt
+        pmx_vec[i] = result[traci.constants.VAR_PMXEMISSION] * dt
+        noise_vec[i] = result[traci.constants.VAR_NOISEEMISSION]
+        valid[i] = True
     
+    if not valid.all():
+        return x_vec[valid], y_vec[valid], co_vec[valid], nox_vec[valid], pmx_vec[valid], noise_vec[valid]
     return x_vec, y_vec, co_vec, nox_vec, pmx_vec, noise_vec
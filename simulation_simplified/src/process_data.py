@@ -10,15 +10,56 @@
 #########################################  
 
 
-import pandas as pd
-import glob
 import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import numba as nb
 
-from helper import printv, save_vec_to_csv
+from helper import printv, save_vec_to_csv, load_grid, map_in_threads
 
 from config import GRID_DIM_X, GRID_DIM_Y
 
+# data_<type>[_<height>]_<seconds of the day>[.<fraction>].csv
+DATA_FILENAME_RE = re.compile(r'^data_([^_]+)_(?:(\d+)_)?(\d+)(?:\.\d+)?\.csv$')
+
+IO_THREADS = 4  # Background threads writing the output csv files of one data type
+
+#########################################
+# Numba kernels
+#########################################  
+
+@nb.njit(nogil=True, cache=True)
+def _stack_statistics(stack):
+    """
+    Max (starting at zero), min and sum over the time axis of a (time, x, y) stack in a single pass.
+    Serial and without the GIL, the data types run concurrently in threads (see process_data_statistics).
+
+    Args:
+        stack (numpy 3D array): Grids of all timestamps.
+
+    Returns:
+        tuple: (max_array, min_array, sum_array), each numpy 2D array (x, y).
+    """
+    n_t, n_x, n_y = stack.shape
+    max_array = np.zeros((n_x, n_y))
+    min_array = stack[0].copy()
+    sum_array = np.zeros((n_x, n_y))
+    for i in range(n_x):
+        for t in range(n_t):
+            for j in range(n_y):
+                v = stack[t, i, j]
+                # NaN propagates like in np.maximum / np.minimum
+                if max_array[i, j] == max_array[i, j] and not v <= max_array[i, j]:
+                    max_array[i, j] = v
+                if min_array[i, j] == min_array[i, j] and not v >= min_array[i, j]:
+                    min_array[i, j] = v
+                sum_array[i, j] += v
+    return max_array, min_array, sum_array
+
+
+
 #########################################
 # Functions
 #########################################  
@@ -34,60 +75,50 @@ def process_data_statistics(data_folder, avg_data_folder, verbose=False):
     printv("Start function process_data_statistics",
            verbose=verbose, color="cyan", decorate=True)
 
-    # Get all files matching the pattern "data_*_*.csv"
-    file_pattern = os.path.join(data_folder, "data_*_*.csv")
-    files = glob.glob(file_pattern)
+    # Get all data files "data_*.csv" (single directory scan, the exact name format is checked below)
+    files = [entry.path for entry in os.scandir(data_folder) if entry.name.startswith("data_") and entry.name.endswith(".csv")]
 
-    print(f"Found {len(files)} files matching the pattern: {file_pattern}")
+    print(f"Found {len(files)} data files in: {data_folder}")
 
     # Group files by data type
     data_types = {}
     for file in files:
         filename = os.path.basename(file)
-        parts = filename.split("_")
-        if len(parts) == 3: # noise data or old formatting without height example: data_co_3000
-            data_key = f"{parts[0]}_{parts[1]}"  # e.g., "data_co"
-
-            # Extract timestamp (seconds of the day) from the filename
-            # Handle potential file extensions like .csv
-            timestamp_str = parts[2].split('.')[0]
-        elif len(parts) == 4: # data with height, example: data_co_1_3000
-            data_key = f"{parts[0]}_{parts[1]}"  # e.g., "data_co"
-            height = int(parts[2])  # e.g., "1"
-            if height != 1:
-                continue
-            timestamp_str = parts[3].split('.')[0]
-        else:
-            break
-
-        try:
-            timestamp = int(timestamp_str)
-
-            # round to closest 3600*k
-            timestamp = round(timestamp / 3600) * 3600
-            # check if the timestamp is valid
-            if timestamp < 0 or timestamp > 86400:
-                printv(f"Warning: Invalid timestamp {timestamp} in filename: {filename}",
-                        verbose=verbose, color="yellow")
-                continue
-
-            # check if our dict already has this kind of information, else create
-            if data_key not in data_types:
-                data_types[data_key] = []
-
-            # Store both file path and its timestamp
-            data_types[data_key].append((file, timestamp))
-        except ValueError:
+
+        # Noise data or old formatting without height (data_co_3000.csv) or data with height (data_co_1_3000.csv)
+        match = DATA_FILENAME_RE.match(filename)
+        if match is None:
             printv(f"Warning: Couldn't parse timestamp from filename: {filename}",
                     verbose=verbose, color="yellow")
+            continue
+
+        pollutant, height, timestamp_str = match.groups()
+        data_key = f"data_{pollutant}"  # e.g., "data_co"
+        if height is not None and int(height) != 1:
+            continue
+
+        # Timestamp (seconds of the day), rounded to closest 3600*k
+        timestamp = round(int(timestamp_str) / 3600) * 3600
+        # check if the timestamp is valid
+        if timestamp < 0 or timestamp > 86400:
+            printv(f"Warning: Invalid timestamp {timestamp} in filename: {filename}",
+                    verbose=verbose, color="yellow")
+            continue
+
+        # Store both file path and its timestamp
+        data_types.setdefault(data_key, []).append((file, timestamp))
 
-    # Process each data type
-    for data_key, file_data in data_types.items():
-        calculate_statistics(data_key, file_data, avg_data_folder, verbose=verbose)
+    # Process each data type (independent files and outputs -> in parallel threads)
+    map_in_threads(_calculate_statistics_task, [(data_key, file_data, avg_data_folder, verbose) for data_key, file_data in data_types.items()])
 
     print("All statistics files created successfully")
 
 
+def _calculate_statistics_task(args):
+    data_key, file_data, avg_data_folder, verbose = args
+    calculate_statistics(data_key, file_data, avg_data_folder, verbose=verbose)
+
+
 def calculate_statistics(data_key, file_data, avg_data_folder, verbose=False):
     """
     Calculate max, min, avg, and max-min difference for a specific data type,
@@ -100,41 +131,40 @@ def calculate_statistics(data_key, file_data, avg_data_folder, verbose=False):
         verbose (bool): if more to be printed
     """
 
-    # Initialize arrays for statistics
-    max_array = np.zeros((GRID_DIM_X, GRID_DIM_Y))
-    min_array = np.full((GRID_DIM_X, GRID_DIM_Y), np.inf)
-    sum_array = np.zeros((GRID_DIM_X, GRID_DIM_Y))
-
-
     # Sort file_data by timestamp
     file_data.sort(key=lambda x: x[1])
 
     printv(f"Running statistics for files of type {data_key}: ", verbose=verbose, color="cyan", decorate=True)
-    for file, timestamp in file_data:
-        printv(f"  {file} at {timestamp}", verbose=verbose)
+    if verbose:  # no message formatting per file otherwise
+        for file, timestamp in file_data:
+            printv(f"  {file} at {timestamp}", verbose=verbose)
 
     # Count for average calculation
     file_list = [item[0] for item in file_data]
     file_count = len(file_list)
 
-    # Dictionary to store data for each timestamp
-    timestamp_data = {}
-
-    # Process each file for this data type
-    for file, timestamp in file_data:
-        # Read the CSV file
-        df = pd.read_csv(file)
-
-        # Convert to numpy array
-        current_array = df.values
-
-        # Store data for this timestamp
-        timestamp_data[timestamp] = current_array
-
-        # Update statistics arrays for overall statistics
-        max_array = np.maximum(max_array, current_array)
-        min_array = np.minimum(min_array, current_array)
-        sum_array += current_array
+    # Timestamps in sorted order
+    times = np.array([timestamp for _, timestamp in file_data], dtype=np.int64)
+
+    if file_count > 0:
+        # Read all files into one stacked (time, x, y) array, memory mapped to an anonymous temporary file
+        # in the output folder -> only the grids in use stay in RAM (page cache), the file is gone once the stack is freed
+        stack = None
+        for i, (file, timestamp) in enumerate(file_data):
+            current_array = load_grid(file)
+            if stack is None:
+                with tempfile.TemporaryFile(dir=avg_data_folder) as stack_file:
+                    stack = np.memmap(stack_file, dtype=current_array.dtype, mode="w+",
+                                      shape=(file_count,) + current_array.shape)
+            stack[i] = current_array
+
+        # Overall statistics in one fused pass over the stack (max starts at zero, as empty cells count as no emission)
+        max_array, min_array, sum_array = _stack_statistics(stack)
+    else:
+        max_array = np.zeros((GRID_DIM_X, GRID_DIM_Y))
+        min_array = np.zeros((GRID_DIM_X, GRID_DIM_Y))
+        sum_array = np.zeros((GRID_DIM_X, GRID_DIM_Y))
+        stack = np.zeros((0, GRID_DIM_X, GRID_DIM_Y))
 
     # Replace infinity with zeros in min_array (for cells that had no data)
     min_array[np.isinf(min_array)] = 0
@@ -145,41 +175,52 @@ def calculate_statistics(data_key, file_data, avg_data_folder, verbose=False):
     # Calculate max-min difference
     diff_array = max_array - min_array
 
-    # Save overall statistics to files in the processed_data directory
-    save_vec_to_csv(max_array, avg_data_folder, f"{data_key}_max.csv")
-    save_vec_to_csv(min_array, avg_data_folder, f"{data_key}_min.csv")
-    save_vec_to_csv(avg_array, avg_data_folder, f"{data_key}_avg.csv")
-    save_vec_to_csv(diff_array, avg_data_folder, f"{data_key}_diff.csv")
+    # Output files are written by background threads while the next arrays are calculated (every array is a new one, no copies needed)
+    with ThreadPoolExecutor(max_workers=IO_THREADS) as io_pool:
+        # Save overall statistics to files in the processed_data directory
+        writes = [io_pool.submit(save_vec_to_csv, max_array, avg_data_folder, f"{data_key}_max.csv"),
+                  io_pool.submit(save_vec_to_csv, min_array, avg_data_folder, f"{data_key}_min.csv"),
+                  io_pool.submit(save_vec_to_csv, avg_array, avg_data_folder, f"{data_key}_avg.csv"),
+                  io_pool.submit(save_vec_to_csv, diff_array, avg_data_folder, f"{data_key}_diff.csv")]
+
+        # Moving averages use one grid per timestamp (of files with the same rounded timestamp the last one counts)
+        unique_time = np.append(times[1:] != times[:-1], True)
+        times, cube = (times, stack) if unique_time.all() else (times[unique_time], stack[unique_time])
 
+        # Calculate moving averages
+        writes += calculate_moving_averages(data_key, times, cube,
+                                            avg_data_folder, verbose, io_pool=io_pool)
 
-    # Calculate moving averages
-    calculate_moving_averages(data_key, timestamp_data,
-                              avg_data_folder, verbose)
+    # All writes are done, raise their errors (if any)
+    for write in writes:
+        write.result()
 
     print(f"Statistics for {data_key} saved successfully")
 
 
-def calculate_moving_averages(data_key, timestamp_data, avg_data_folder, verbose=False):
+def calculate_moving_averages(data_key, times, cube, avg_data_folder, verbose=False, io_pool=None):
     """
     Calculate hourly, 8-hourly, and 24-hourly moving averages
 
     Args:
         data_key: Data type key (e.g., "data_co")
-        timestamp_data: Dictionary mapping timestamps to data arrays
+        times: Sorted numpy array of the (unique) timestamps
+        cube: Numpy array (time, x, y), cube[i] is the data at times[i]
         avg_data_folder: Path to save the processed data files
         verbose: Whether to print verbose output
+        io_pool: Optional ThreadPoolExecutor to write the files in the background
+
+    Returns:
+        List of futures of the pending writes (empty without io_pool)
     """
     # Constants for time intervals in seconds
     HOUR_SEC = 3600
     EIGHT_HOUR_SEC = 8 * HOUR_SEC
     DAY_SEC = 24 * HOUR_SEC
 
-    # Get sorted timestamps
-    timestamps = sorted(timestamp_data.keys())
-
-    if len(timestamps) == 0:
+    if len(times) == 0:
         printv(f"No data available for {data_key}", verbose=verbose, color="yellow")
-        return
+        return []
 
     # Define moving average windows to process
     windows = [
@@ -189,63 +230,71 @@ def calculate_moving_averages(data_key, timestamp_data, avg_data_folder, verbose
     ]
 
     # Calculate moving averages for each window type
+    writes = []
     for window in windows:
         printv(f"Calculating {window['name']} averages for {data_key}...", verbose=verbose)
-        calculate_moving_average_for_window(
+        writes += calculate_moving_average_for_window(
             data_key, 
-            timestamps, 
-            timestamp_data, 
+            times, 
+            cube, 
             window["window_size"], 
             window["min_points"], 
             window["name"], 
             window["label"],
-            avg_data_folder
+            avg_data_folder,
+            verbose,
+            io_pool
         )
 
+    return writes
 
-def calculate_moving_average_for_window(data_key, timestamps, timestamp_data, window_size, min_points, 
-                                        window_name, time_label, avg_data_folder):
+
+def calculate_moving_average_for_window(data_key, times, cube, window_size, min_points, 
+                                        window_name, time_label, avg_data_folder, verbose=False, io_pool=None):
     """
     Calculate moving average for a specific window size
     
     Args:
         data_key: Data type key (e.g., "data_co")
-        timestamps: Sorted list of timestamps
-        timestamp_data: Dictionary mapping timestamps to data arrays
+        times: Sorted numpy array of the (unique) timestamps
+        cube: Numpy array (time, x, y), cube[i] is the data at times[i]
         window_size: Size of the window in seconds
         min_points: Minimum number of data points required to calculate the average
         window_name: Name of the window (e.g., "1h", "8h", "24h")
         time_label: Label to use in the filename (e.g., "hour", "from_hour")
         avg_data_folder: Path to save the processed data files
+        verbose: Whether to print verbose output
+        io_pool: Optional ThreadPoolExecutor to write the files in the background
+
+    Returns:
+        List of futures of the pending writes (empty without io_pool)
     """
     HOUR_SEC = 3600  # Hours in seconds for timestamp conversion
-    print("In function calculate_moving_average_for_window")
+    printv("In function calculate_moving_average_for_window", verbose=verbose, color="cyan")
+    writes = []
     
-    for start_time in timestamps:
+    # Window of every start time: timestamps in [start_time, start_time + window_size) -> indices [start, end) (binary search instead of a scan)
+    window_ends = np.searchsorted(times, times + window_size, side='left')
+
+    for start, (start_time, end) in enumerate(zip(times.tolist(), window_ends)):
         # Define the window end time
         end_time = start_time + window_size
-
-        # Find timestamps that fall within this window
-        window_timestamps = [t for t in timestamps if start_time <= t < end_time]
-        print(f"  Window from {start_time} to {end_time}: {len(window_timestamps)} timestamps")
+        count = int(end - start)
+        if verbose:  # no message formatting per window otherwise
+            printv(f"  Window from {start_time} to {end_time}: {count} timestamps", verbose=verbose)
 
         # Only calculate if we have enough data points
-        if len(window_timestamps) >= min_points:
-            print("in if len(window_timestamps) >= min_points")
-            # Initialize sum array and count
-            window_sum = np.zeros((GRID_DIM_X, GRID_DIM_Y))
-            count = 0
-
-            # Sum up all arrays within the window
-            for t in window_timestamps:
-                window_sum += timestamp_data[t]
-                count += 1
-
-            # Calculate average
-            window_avg = window_sum / count
+        if count >= min_points:
+            # Average of all arrays within the window (one reduction, no cumulative sums -> no cancellation errors)
+            window_avg = cube[start:end].sum(axis=0) / count
 
             # Save to file with timestamp information
             start_hour = int(start_time / HOUR_SEC)
             filename = f"{data_key}_{window_name}_avg_{time_label}{start_hour}.csv"
-            save_vec_to_csv(window_avg, avg_data_folder, filename)
+            if io_pool is None:
+                save_vec_to_csv(window_avg, avg_data_folder, filename)
+            else:
+                writes.append(io_pool.submit(save_vec_to_csv, window_avg, avg_data_folder, filename))
+
+    return writes
 
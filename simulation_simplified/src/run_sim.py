@@ -13,15 +13,22 @@ import os
 import sys
 if 'SUMO_HOME' in os.environ:
     sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
+import importlib.util
+from config import SHOW_INTERFACE
+# Without the GUI SUMO runs inside this process via libsumo (same API as traci, no socket round trip per call) if it is installed,
+# with LIBSUMO_AS_TRACI set the traci package is libsumo for every module
+if not SHOW_INTERFACE and importlib.util.find_spec("libsumo") is not None:
+    os.environ.setdefault("LIBSUMO_AS_TRACI", "1")
 import traci
 import numpy as np
 import time
 import math
+from concurrent.futures import ThreadPoolExecutor
 
-from emission_models import process_gas_step, process_noise, calculate_optimal_dt, get_emissions_batched
+from emission_models import make_gas_stepper, find_active_box, step_all_gases_cuda, gases_to_device, gases_to_host, GPU_AVAILABLE, process_noise, accumulate_noise_exposure, calculate_optimal_dt, get_emissions_batched
 from helper import get_cell_size, printv, parse_args, save_vec_to_csv, save_all_data
-from sumo_commands import startSumo, stopSumo, update_edge_speeds, reroute_vehicles_to_avoid_traffic, add_time_dependent_traffic
-from config import GRID_LEFT, GRID_RIGHT, GRID_BOTTOM, GRID_TOP, GRID_DIM_X, GRID_DIM_Y, GRID_DIM_Z, NETWORK_FILE, VERBOSE, FORCE_RECALCULATE, TIME_PER_SCREENSHOT, SHOW_INTERFACE, VILLAGE_NAME, REROUTING_PERIOD, DATE
+from sumo_commands import startSumo, stopSumo, get_vehicle_ids, update_edge_speeds, reroute_vehicles_to_avoid_traffic, add_time_dependent_traffic
+from config import GRID_LEFT, GRID_RIGHT, GRID_BOTTOM, GRID_TOP, GRID_DIM_X, GRID_DIM_Y, GRID_DIM_Z, NETWORK_FILE, VERBOSE, FORCE_RECALCULATE, TIME_PER_SCREENSHOT, SHOW_INTERFACE, VILLAGE_NAME, REROUTING_PERIOD, DATE, USE_GPU
 from post_processing import post_processing_wrapper
 
 
@@ -111,12 +118,10 @@ NOISE_THRESHOLD_LOW = 40
 NOISE_THRESHOLD_MID = 50   
 NOISE_THRESHOLD_HIGH = 60  
 NOISE_THERESHOLD_VERY_HIGH = 70
+noise_thresholds = np.array([NOISE_THRESHOLD_LOW, NOISE_THRESHOLD_MID, NOISE_THRESHOLD_HIGH, NOISE_THERESHOLD_VERY_HIGH], dtype=np.float64)
 
-# Counters for number of seconds above threshold
-noise_exposure_low = np.zeros((GRID_DIM_X, GRID_DIM_Y), dtype=np.int32)
-noise_exposure_mid = np.zeros((GRID_DIM_X, GRID_DIM_Y), dtype=np.int32)
-noise_exposure_high = np.zeros((GRID_DIM_X, GRID_DIM_Y), dtype=np.int32)
-noise_exposure_very_high = np.zeros((GRID_DIM_X, GRID_DIM_Y), dtype=np.int32)
+# Counters for number of seconds above threshold, one (GRID_DIM_X, GRID_DIM_Y) slice per threshold (int32, a day has more seconds than int16 can count)
+noise_exposure = np.zeros((len(noise_thresholds), GRID_DIM_X, GRID_DIM_Y), dtype=np.int32)
 
 
 #########################################
@@ -135,13 +140,28 @@ loss_rate_co = 0.0
 loss_rate_nox = 0.0  
 loss_rate_pmx = 0.001  # [1/s] -> loss rate of PM2.5
 
+# Per gas constants in the order (CO, NOx, PMx) of step_all_gases, built once instead of every step
+gas_default_values = np.array([CO_default_mgm3, NO2_default_mgm3, PM2_default_mgm3])
+gas_diffusions = np.array([diffusion_CO, diffusion_nox, diffusion_pmx])
+gas_loss_rates = np.array([loss_rate_co, loss_rate_nox, loss_rate_pmx])
+
+# On the GPU the gas grids stay on the device and are only copied back for the screenshots
+use_gpu = USE_GPU and GPU_AVAILABLE
+if USE_GPU and not GPU_AVAILABLE:
+    printv("No CUDA GPU available, running the diffusion on the CPU", VERBOSE, "yellow")
+if use_gpu:
+    gas_grids_gpu, gas_grids_gpu_next = gases_to_device(co_vector_global_mgcell, nox_vector_global_mgcell, pmx_vector_global_mgcell)
+
+# Cells that differ from the default values, only these (and their growing neighbourhood) are diffused
+active_box = find_active_box(co_vector_global_mgcell, nox_vector_global_mgcell, pmx_vector_global_mgcell, gas_default_values, cell_len_x_m, cell_len_y_m, cell_len_z_m)
+
 # Calculate timestep dt based on diffusion and loss rates using CFL condition (worst-case scenario)
 dt = calculate_optimal_dt(
     cell_len_x_m=cell_len_x_m,
     cell_len_y_m=cell_len_y_m,
     cell_len_z_m=cell_len_z_m,
-    diffusion=max(diffusion_CO, diffusion_nox, diffusion_pmx),
-    loss_rate=max(loss_rate_co, loss_rate_nox, loss_rate_pmx),
+    diffusion=gas_diffusions.max(),
+    loss_rate=gas_loss_rates.max(),
     safety_factor=0.8  # 20% safety margin
 )
 
@@ -151,19 +171,41 @@ dt = 1/n  # Set dt to this fraction
 
 # Cap dt at 1 second to prevent excessive simulation time (maybe redundant)
 dt = min(dt, 1)  # Cap at 1 second
+
+# SUMO keeps time in whole milliseconds -> use the rounded step it actually takes, so the diffusion and the clock below match SUMO
+step_ms = round(1000 / n)
+if step_ms < 1:
+    raise ValueError(f"Timestep dt = {dt} s is below SUMO's resolution of 1 ms")
+dt = step_ms / 1000
 printv(f"Using auto-calculated timestep dt = {dt} seconds", VERBOSE, "yellow")
 
-# Floatingpoint safe modulo scheme
-next_screenshot_time = TIME_PER_SCREENSHOT
-next_rerouting_time = REROUTING_PERIOD
-next_noise_update = 1.0
+# Diffusion step with all constants of this simulation bound once
+step_all_gases = make_gas_stepper(cell_len_x_m, cell_len_y_m, cell_len_z_m, gas_default_values, gas_diffusions, gas_loss_rates, dt)
+
+# Integer millisecond clock instead of floating point times (SUMO advances step_ms per step), no TraCI time query per step
+total_steps = math.ceil(round(SIM_TIME * 1000) / step_ms)
+screenshot_ms = round(TIME_PER_SCREENSHOT * 1000)
+rerouting_ms = round(REROUTING_PERIOD * 1000)
+rerouting_enabled = abs(REROUTING_PERCENTAGE) > 0.000001 # floating point safe check, to see if percentage is not zero
+noise_ms = 1000
+
+
+def period_crossed(curr_time_ms, period_ms):
+    """True if the last step crossed a multiple of period_ms (a step of step_ms rarely lands exactly on it)"""
+    return curr_time_ms // period_ms > (curr_time_ms - step_ms) // period_ms
+
+
+# Screenshots are written by a background thread while the simulation continues
+screenshot_pool = ThreadPoolExecutor(max_workers=1)
+screenshot_writes = []
 
 
 startSumo(200, GRID_LEFT, GRID_TOP, visual_interface=SHOW_INTERFACE, verbose=VERBOSE, dt=dt)
 
-while traci.simulation.getTime() <= SIM_TIME:
+for step in range(total_steps + 1):
 
-    curr_time = traci.simulation.getTime()
+    curr_time_ms = step * step_ms  # equals SUMO's time
+    curr_time = curr_time_ms / 1000
     traci.simulationStep()
 
     #########################################
@@ -174,22 +216,21 @@ while traci.simulation.getTime() <= SIM_TIME:
     #########################################
     # Random traffic generation
     #########################################
-    try:
-        if RANDOM_TRAFFIC:
+    # a failed spawn should not end the whole simulation -> report and continue (no exception handling at all without random traffic)
+    if RANDOM_TRAFFIC:
+        try:
             add_time_dependent_traffic(WEEKDAY, curr_time, dt, population_with_car, working_population, inactive_population) # adds random traffic to the simulation
-    except Exception as e:
-        print(f"Error adding traffic: {e}")
+        except Exception as e:
+            printv(f"Error adding traffic: {e}", verbose=True, color="red")
 
-    vehicle_ids = list(traci.vehicle.getIDList()) # get vehicles after spawning new ones
+    vehicle_ids = get_vehicle_ids() # vehicles in the network after the step (spawned vehicles enter with the next step)
 
     #########################################
     # Reroute vehicles to avoid traffic jams
     #########################################
     # reroute a specific percentage of vehicles every REROUTING_PERIOD seconds
-    if next_rerouting_time <= curr_time:
-        next_rerouting_time += REROUTING_PERIOD
-        if abs(REROUTING_PERCENTAGE) > 0.000001: # floating point safe check, to see if percentage is not zero
-            reroute_vehicles_to_avoid_traffic(REROUTING_PERCENTAGE, vehicle_ids)
+    if rerouting_enabled and step > 0 and period_crossed(curr_time_ms, rerouting_ms):
+        reroute_vehicles_to_avoid_traffic(REROUTING_PERCENTAGE, vehicle_ids)
 
     #########################################
     # Add emissions from vehicles and diffuse pollutants
@@ -197,52 +238,60 @@ while traci.simulation.getTime() <= SIM_TIME:
     # get emissions from vehicles
     x_vec, y_vec, co_vec, nox_vec, pmx_vec, noise_vec = get_emissions_batched(vehicle_ids, dt)
 
-    # diffusion and loss of pollutants
-    co_vector_global_mgcell = process_gas_step(old_matrix=co_vector_global_mgcell, x_vec=x_vec, y_vec=y_vec, emission_vec=co_vec,
-                                               cell_len_y_m=cell_len_y_m, cell_len_x_m=cell_len_x_m, cell_len_z_m=cell_len_z_m, default_value=CO_default_mgm3, diffusion=diffusion_CO, loss_rate=loss_rate_co, dt=dt)
-    nox_vector_global_mgcell = process_gas_step(old_matrix=nox_vector_global_mgcell, x_vec=x_vec, y_vec=y_vec, emission_vec=nox_vec,
-                                                cell_len_y_m=cell_len_y_m, cell_len_x_m=cell_len_x_m, cell_len_z_m=cell_len_z_m, default_value=NO2_default_mgm3, diffusion=diffusion_nox, loss_rate=loss_rate_nox, dt=dt)
-    pmx_vector_global_mgcell = process_gas_step(old_matrix=pmx_vector_global_mgcell, x_vec=x_vec, y_vec=y_vec, emission_vec=pmx_vec,
-                                                cell_len_y_m=cell_len_y_m, cell_len_x_m=cell_len_x_m, cell_len_z_m=cell_len_z_m, default_value=PM2_default_mgm3, diffusion=diffusion_pmx,  loss_rate=loss_rate_pmx, dt=dt)
+    # diffusion and loss of pollutants (all three gases in one pass over the grid)
+    if use_gpu:
+        gas_grids_gpu, gas_grids_gpu_next = step_all_gases_cuda(
+            gas_grids_gpu, gas_grids_gpu_next, x_vec, y_vec, co_vec, nox_vec, pmx_vec,
+            cell_len_x_m, cell_len_y_m, cell_len_z_m, gas_default_values, gas_diffusions, gas_loss_rates, dt=dt)
+    else:
+        co_vector_global_mgcell, nox_vector_global_mgcell, pmx_vector_global_mgcell = step_all_gases(
+            co_vector_global_mgcell, nox_vector_global_mgcell, pmx_vector_global_mgcell, x_vec, y_vec, co_vec, nox_vec, pmx_vec, active_box)
 
     #########################################
     # Every second, process noise exposure and add to binary counters
     #########################################    
-    if next_noise_update <= curr_time:
-        next_noise_update += 1.0
+    if step > 0 and period_crossed(curr_time_ms, noise_ms):
         
         # Calculate current noise grid
         current_noise_grid = process_noise(x_vec=x_vec, y_vec=y_vec, noise_vec=noise_vec, cell_len_x_m=cell_len_x_m, cell_len_y_m=cell_len_y_m)
         
-        noise_exposure_low += (current_noise_grid >= NOISE_THRESHOLD_LOW).astype(np.int32)
-        noise_exposure_mid += (current_noise_grid >= NOISE_THRESHOLD_MID).astype(np.int32)
-        noise_exposure_high += (current_noise_grid >= NOISE_THRESHOLD_HIGH).astype(np.int32)
-        noise_exposure_very_high += (current_noise_grid >= NOISE_THERESHOLD_VERY_HIGH).astype(np.int32)
+        accumulate_noise_exposure(current_noise_grid, noise_thresholds, noise_exposure)
 
     #########################################
     # Take screenshot of data every TIME_PER_SCREENSHOT seconds
     #########################################  
-    if next_screenshot_time <= curr_time:
-        next_screenshot_time += TIME_PER_SCREENSHOT
-        printv(f"Taking screenshot at time {curr_time} seconds of total {SIM_TIME}", VERBOSE, "yellow")
+    if step > 0 and period_crossed(curr_time_ms, screenshot_ms):
+        screenshot_time = curr_time_ms // screenshot_ms * screenshot_ms / 1000  # label with the crossed boundary, as in the output time series
+        printv(f"Taking screenshot at time {screenshot_time} seconds of total {SIM_TIME}", VERBOSE, "yellow")
         noise_grid = process_noise(x_vec=x_vec, y_vec=y_vec, noise_vec=noise_vec, cell_len_x_m=cell_len_x_m, cell_len_y_m=cell_len_y_m)
 
-        save_all_data(co_vector_global=co_vector_global_mgcell, 
+        if use_gpu:
+            co_vector_global_mgcell, nox_vector_global_mgcell, pmx_vector_global_mgcell = gases_to_host(gas_grids_gpu)
+
+        screenshot_writes += save_all_data(co_vector_global=co_vector_global_mgcell, 
               nox_vector_global=nox_vector_global_mgcell,
               pmx_vector_global=pmx_vector_global_mgcell, 
               noise_vector=noise_grid, 
               folder_path=DATA_FOLDER, 
-              identifier=f"{curr_time}",
+              identifier=f"{screenshot_time}",
               cell_len_x_m=cell_len_x_m, 
               cell_len_y_m=cell_len_y_m, 
-              cell_len_z_m=cell_len_z_m)
+              cell_len_z_m=cell_len_z_m,
+              io_pool=screenshot_pool)
+
+        # Shrink the active box to the cells that still differ from the default values
+        if not use_gpu:
+            active_box = find_active_box(co_vector_global_mgcell, nox_vector_global_mgcell, pmx_vector_global_mgcell, gas_default_values, cell_len_x_m, cell_len_y_m, cell_len_z_m)
         
 
 printv("Saving noise threshold data to CSV files", VERBOSE, "yellow")
-save_vec_to_csv(noise_exposure_low, DATA_FOLDER, f"noise_exposure_{NOISE_THRESHOLD_LOW}db.csv")
-save_vec_to_csv(noise_exposure_mid, DATA_FOLDER, f"noise_exposure_{NOISE_THRESHOLD_MID}db.csv") 
-save_vec_to_csv(noise_exposure_high, DATA_FOLDER, f"noise_exposure_{NOISE_THRESHOLD_HIGH}db.csv")
-save_vec_to_csv(noise_exposure_very_high, DATA_FOLDER, f"noise_exposure_{NOISE_THERESHOLD_VERY_HIGH}db.csv")
+for threshold, exposure in zip((NOISE_THRESHOLD_LOW, NOISE_THRESHOLD_MID, NOISE_THRESHOLD_HIGH, NOISE_THERESHOLD_VERY_HIGH), noise_exposure):
+    save_vec_to_csv(exposure, DATA_FOLDER, f"noise_exposure_{threshold}db.csv")
+
+# Wait for the screenshots, raise their errors (if any)
+for write in screenshot_writes:
+    write.result()
+screenshot_pool.shutdown()
 
 
 #########################################
@@ -10,17 +10,21 @@
 #########################################  
 
 import traci
+import traci.constants as tc
 import pandas as pd
 import os
 import numpy as np
 import random
 import datetime
+import json
 
-from config import SUMO_FILE, SPEED_FILE
+from config import SUMO_FILE, SPEED_FILE, NETWORK_FILE, FORCE_RECALCULATE
 from helper import printv
+from emission_models import EMISSION_VARIABLES
 
 # set seed for reproducibility
 random.seed(42)
+rng = np.random.default_rng(42)
 
 
 
@@ -68,7 +72,10 @@ def startSumo(zoom, x_off, y_off, dt=1.0, visual_interface=True, verbose=True):
     
     # Start SUMO
     try:
-        traci.start(sumoCmd, label=f"test_label_{unique}")
+        if getattr(traci, "isLibsumo", lambda: False)():  # in-process libsumo, a single simulation without connection labels
+            traci.start(sumoCmd)
+        else:
+            traci.start(sumoCmd, label=f"test_label_{unique}")
     except Exception as e:
         printv(f"Error starting SUMO: {e}", verbose=verbose, color="red")
         raise
@@ -83,6 +90,9 @@ def startSumo(zoom, x_off, y_off, dt=1.0, visual_interface=True, verbose=True):
 
     if verbose:
         print("Started SUMO")
+
+    # Departed and arrived vehicles arrive with every simulation step (see get_vehicle_ids)
+    traci.simulation.subscribe([tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_ARRIVED_VEHICLES_IDS])
         
     precompute_suitable_edges()
     create_delivery_vehicle_type()
@@ -99,10 +109,78 @@ def stopSumo(verbose=False):
     printv("Start function stopSumo", verbose=verbose, color="blue", decorate=True)
 
     traci.close()
+    AGGREGATED_ROUTING_VEHICLES.clear()  # vehicle ids may be reused by the next simulation
+    ACTIVE_VEHICLES.clear()
+
+
+# Vehicles currently in the network, in order of departure (dict used as ordered set)
+ACTIVE_VEHICLES = {}
+def get_vehicle_ids():
+    """
+    Get the vehicles in the network after the last simulation step, from the departed and arrived vehicles
+    of the simulation subscription (no extra TraCI request). Departed vehicles are subscribed to their emissions.
+
+    Returns:
+        list: IDs of the vehicles in the network
+    """
+    results = traci.simulation.getSubscriptionResults()
+    for vehicle_id in results.get(tc.VAR_DEPARTED_VEHICLES_IDS, ()):
+        ACTIVE_VEHICLES[vehicle_id] = None
+        traci.vehicle.subscribe(vehicle_id, EMISSION_VARIABLES)
+    for vehicle_id in results.get(tc.VAR_ARRIVED_VEHICLES_IDS, ()):
+        ACTIVE_VEHICLES.pop(vehicle_id, None)
+    return list(ACTIVE_VEHICLES)
+
+
+def load_speed_data():
+    """
+    Load the edge speeds as a plain array (row = time step, column = edge), no pandas indexing per step.
+    The array and the edge ids are cached in the temp output folder (.npy, memory mapped on later runs, and .json),
+    the cache is rebuilt when the speed file it was built from is newer.
+
+    Returns:
+        tuple: (list of edge ids, numpy 2D array of the speeds)
+    """
+    speed_base = os.path.splitext(SPEED_FILE)[0]
+    cache_folder = "../output/temp/"
+    cache_base = os.path.join(cache_folder, "cached_" + os.path.basename(speed_base))
+    cache_values_file = cache_base + "_speeds.npy"
+    cache_edges_file = cache_base + "_edges.json"
+
+    # Prefer the parquet copy next to the CSV file (much faster to load), the cache is checked against the file actually read
+    speed_parquet_file = speed_base + ".parquet"
+    source_file = speed_parquet_file if os.path.exists(speed_parquet_file) else SPEED_FILE
+    if not os.path.exists(source_file):
+        raise FileNotFoundError(f"Speed file {SPEED_FILE} not found (a cached copy without its source is not used)")
+    source_mtime = os.path.getmtime(source_file)
+
+    if os.path.exists(cache_values_file) and os.path.exists(cache_edges_file) \
+            and os.path.getmtime(cache_values_file) >= source_mtime and os.path.getmtime(cache_edges_file) >= source_mtime:
+        with open(cache_edges_file, 'r') as f:
+            edge_ids = json.load(f)
+        return edge_ids, np.load(cache_values_file, mmap_mode='r')
+
+    if source_file == speed_parquet_file:
+        speed_data = pd.read_parquet(speed_parquet_file)
+    else:
+        speed_data = pd.read_csv(SPEED_FILE)
+    edge_ids = [column for column in speed_data.columns if column != 'time']
+    values = speed_data[edge_ids].to_numpy(dtype=np.float64)
+
+    # Save the cache for the next runs (not possible e.g. in a read-only folder -> just use the data)
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        np.save(cache_values_file, values)
+        with open(cache_edges_file, 'w') as f:
+            json.dump(edge_ids, f)
+    except OSError as e:
+        print(f"Could not cache the speed data: {e}")
 
+    return edge_ids, values
 
-# Import the speed data from the CSV file once
-speed_data = pd.read_csv(SPEED_FILE) # call once at the beginning
+
+# Import the speed data once
+speed_edge_ids, speed_values = load_speed_data()
 def update_edge_speeds(time_step):
     """
     Update edge speeds based on the current simulation time. Looks at data from the CSV file, generated by Manon files.
@@ -114,25 +192,20 @@ def update_edge_speeds(time_step):
         None
     """
     # Get the speeds for the current time step (if available)
-    if int(time_step) < len(speed_data):
-        current_speeds = speed_data.iloc[int(time_step)]
-        
-        # Process each edge in the CSV
-        for edge in current_speeds.keys():
-            if edge == 'time':  # Skip the time column
-                continue
-                
-            # Get the edge ID without the 'lane_exit_' prefix
-            speed = current_speeds[edge]
-            
-            # Apply speed only if not -1.0 (placeholds for the morning)
-            if speed != -1.0:
-                try:
-                    traci.edge.setMaxSpeed(edge, float(speed))
-                except traci.TraCIException as e:
-                    print(f"Error setting speed for edge {edge}: {e}")
+    if int(time_step) < len(speed_values):
+        current_speeds = speed_values[int(time_step)]
+
+        # Apply speed only if not -1.0 (placeholds for the morning)
+        for i in np.flatnonzero(current_speeds != -1.0):
+            edge = speed_edge_ids[i]
+            try:
+                traci.edge.setMaxSpeed(edge, float(current_speeds[i]))
+            except traci.TraCIException as e:
+                print(f"Error setting speed for edge {edge}: {e}")
 
 
+# Vehicles already switched to the aggregated routing mode
+AGGREGATED_ROUTING_VEHICLES = set()
 def reroute_vehicles_to_avoid_traffic(reroute_percentage, vehicle_ids):
     """
     Reroutes a given percentage of vehicles to avoid traffic.
@@ -149,45 +222,94 @@ def reroute_vehicles_to_avoid_traffic(reroute_percentage, vehicle_ids):
     if num_to_reroute == 0:
         return
         
-    # Randomly select vehicles to reroute
-    vehicles_to_reroute = np.random.choice(vehicle_ids, size=num_to_reroute, replace=False)
+    # Randomly select vehicles to reroute (order of the selection does not matter -> no shuffle)
+    vehicles_to_reroute = rng.choice(np.asarray(vehicle_ids), size=num_to_reroute, replace=False, shuffle=False)
     
     for veh_id in vehicles_to_reroute:
         # Compute new route with current traffic conditions
         traci.vehicle.rerouteTraveltime(veh_id, currentTravelTimes=True)
         
-        traci.vehicle.setRoutingMode(veh_id, 1)  # 1 = ROUTING_MODE_AGGREGATED (looks at the current traffic conditions)
+        # The routing mode only needs to be set once per vehicle
+        if veh_id not in AGGREGATED_ROUTING_VEHICLES:
+            traci.vehicle.setRoutingMode(veh_id, 1)  # 1 = ROUTING_MODE_AGGREGATED (looks at the current traffic conditions)
+            AGGREGATED_ROUTING_VEHICLES.add(veh_id)
+
+
+def get_all_lane_attributes():
+    """
+    Get the allowed vehicle classes and the maximum speed of all lanes with a single TraCI request
+    (context subscription around a junction with a radius covering the whole network), instead of two requests per lane.
+
+    Returns:
+        dict: lane id -> {tc.LANE_ALLOWED: allowed classes, tc.VAR_MAXSPEED: maximum speed}, empty if not available
+    """
+    junctions = traci.junction.getIDList()
+    if not junctions:
+        return {}
+
+    network_radius = 1e9  # [m], more than any network
+    try:
+        traci.junction.subscribeContext(junctions[0], tc.CMD_GET_LANE_VARIABLE, network_radius, [tc.LANE_ALLOWED, tc.VAR_MAXSPEED])
+        lane_attributes = traci.junction.getContextSubscriptionResults(junctions[0]) or {}
+        traci.junction.unsubscribeContext(junctions[0], tc.CMD_GET_LANE_VARIABLE, network_radius)
+    except traci.TraCIException as e:
+        print(f"Error getting the lane attributes in bulk, falling back to single requests: {e}")
+        return {}
+
+    return lane_attributes
 
 
 # Precompute suitable edges for delivery vehicles (the type that can go into housing areas)
 SUITABLE_EDGES = []
 def precompute_suitable_edges():
     """
-    Precompute suitable edges for delivery vehicles to improve performance
+    Precompute suitable edges for delivery vehicles to improve performance.
+    The result is cached in the temp output folder and reused as long as the SUMO config and network files are unchanged.
     """
     global SUITABLE_EDGES
+
+    # Caching logic (the files' modification times are the key)
+    cache_filename = f"../output/temp/cached_suitable_edges_{os.path.splitext(os.path.basename(NETWORK_FILE))[0]}.json"
+    file_times = [os.path.getmtime(file) for file in (SUMO_FILE, NETWORK_FILE) if os.path.exists(file)]
+    if os.path.exists(cache_filename) and not FORCE_RECALCULATE:
+        with open(cache_filename, 'r') as f:
+            cache = json.load(f)
+        if cache["file_times"] == file_times:
+            SUITABLE_EDGES = cache["edges"]
+            print(f"Loaded {len(SUITABLE_EDGES)} suitable edges for delivery vehicles from '{cache_filename}'")
+            return
         
     # Get all edges that can be used as start points
     edges = traci.edge.getIDList()
     suitable_edges = []
+
+    # Lane permissions and speeds of the whole network in one request (lanes missing in it are asked for one by one)
+    lane_attributes = get_all_lane_attributes()
     
     for edge in edges:
         if edge.startswith(':'):  # Skip internal/junction edges
             continue
             
         try:
-            # Check if edge has lanes
-            lane_count = traci.edge.getLaneNumber(edge)
-            if lane_count <= 0:
-                continue
+            lane_id = f"{edge}_0"
+            attributes = lane_attributes.get(lane_id)
+
+            # Check if edge has lanes (the first lane is known -> it has)
+            if attributes is None:
+                lane_count = traci.edge.getLaneNumber(edge)
+                if lane_count <= 0:
+                    continue
                 
             # Check permissions on all lanes
             edge_valid = False
 
-            lane_id = f"{edge}_0"
             try:
-                allowed = traci.lane.getAllowed(lane_id)
-                lane_speed = traci.lane.getMaxSpeed(lane_id)
+                if attributes is not None:
+                    allowed = attributes[tc.LANE_ALLOWED]
+                    lane_speed = attributes[tc.VAR_MAXSPEED]
+                else:
+                    allowed = traci.lane.getAllowed(lane_id)
+                    lane_speed = traci.lane.getMaxSpeed(lane_id)
                 
                 # Calculate if the lane looks like it could be used by private cars (sometimes delivery vehicles only allowed inside the villages)
                 delivery_allowed = (not allowed) or (('delivery' in allowed) and ('pedestrian' not in allowed)) or ('passenger' in allowed)
@@ -213,6 +335,11 @@ def precompute_suitable_edges():
     SUITABLE_EDGES = suitable_edges
     print(f"Precomputed {len(SUITABLE_EDGES)} suitable edges for delivery vehicles (speed limit < 17 m/s)")
 
+    # Save to cache
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    with open(cache_filename, 'w') as f:
+        json.dump({"file_times": file_times, "edges": SUITABLE_EDGES}, f)
+
 
 def add_random_delivery_vehicle():
     """
@@ -227,14 +354,8 @@ def add_random_delivery_vehicle():
     # Try up to 5 times to find a valid route
     for attempt in range(5):
         try:
-            # Generate a random route using precomputed suitable edges
-            from_edge = random.choice(SUITABLE_EDGES)
-            possible_to_edges = [e for e in SUITABLE_EDGES if e != from_edge]
-            
-            if not possible_to_edges:
-                continue
-                
-            to_edge = random.choice(possible_to_edges)
+            # Generate a random route using precomputed suitable edges (two distinct edges, no copy of the edge list)
+            from_edge, to_edge = random.sample(SUITABLE_EDGES, 2)
             
             try:
                 route = traci.simulation.findRoute(from_edge, to_edge, vType="resident_type")
@@ -262,8 +383,7 @@ def add_random_delivery_vehicle():
                     continue
                 
                 # Add the vehicle
-                traci.vehicle.add(veh_id, route_id, typeID="resident_type", departSpeed="0")
-                traci.vehicle.setColor(veh_id, (255, 0, 0, 255)) # red color, easier to see
+                traci.vehicle.add(veh_id, route_id, typeID="resident_type", departSpeed="0")  # red color (easier to see) comes from resident_type
                 traci.vehicle.setSpeedFactor(veh_id, random.uniform(0.8, 1.0))
                 print(f"Successfully added vehicle {veh_id}")
                 return True
@@ -278,6 +398,48 @@ def add_random_delivery_vehicle():
     return False
 
 
+def build_traffic_table(periods):
+    """
+    Build the lookup table of the vehicles per hour for every hour of the day.
+
+    Args:
+        periods (list): Tuples (start_hour, end_hour, shares, spread), shares are the fractions of
+            (population_with_car, working_population, inactive_population) that drive in this period,
+            spread the factor to distribute them over the hours of the period (e.g. 1/3. for 3 hours).
+
+    Returns:
+        tuple: Numpy arrays of the shares (24, 3) and the spread (24,) indexed by the hour.
+    """
+    shares_table = np.zeros((24, 3))
+    spread_table = np.ones(24)
+    for start_hour, end_hour, shares, spread in periods:
+        shares_table[start_hour:end_hour] = shares
+        spread_table[start_hour:end_hour] = spread
+    return shares_table, spread_table
+
+
+WEEKDAY_TRAFFIC = build_traffic_table([
+    (0, 5, (0.001, 0, 0), 1),  # 0.1% of people at night per hour
+    (5, 9, (0, 1, 0), 1/3.),  # working population with car, go to work over 3 hours
+    (9, 11, (0, 0, 0.2), 1/2.),  # 20% of people that stay at home, over 2 hours do something in the morning
+    (11, 13, (0, 0.5, 0), 1/2.),  # 50% of workers go home for lunch,, over two hours
+    (13, 16, (0, 0, 0.15), 1/3.),  # 15 % drive around at afternoon
+    (16, 19, (0, 1, 0), 1/3.),  # working population with car, come home from work over 3 hours
+    (19, 21, (0.1, 0, 0), 1/2.),  # 10% of people do something in the evening, over 2 hours
+    (21, 24, (0.001, 0, 0), 1),  # 0.1% of people at night per hour
+])
+
+# Weekend traffic pattern
+WEEKEND_TRAFFIC = build_traffic_table([
+    (0, 5, (0.001, 0, 0), 1),  # 0.1% of people at night per hour
+    (5, 8, (0.05, 0, 0), 1/3.),  # 5% of people do somehting in the morning
+    (8, 9, (0.001, 0, 0), 1),  # neither morning nor day, same as at night
+    (9, 18, (0.25, 0, 0), 1),  # 25% of people do something during the day -> assuming that families use one car
+    (18, 21, (0.05, 0, 0), 1/3.),  # 5% of peoplen do something in the evening
+    (21, 24, (0.001, 0, 0), 1),  # 0.1% of people at night per hour
+])
+
+
 def add_time_dependent_traffic(weekday, curr_time, dt, population_with_car, working_population, inactive_population):
     """
     Add time-dependent random traffic to the simulation
@@ -296,36 +458,11 @@ def add_time_dependent_traffic(weekday, curr_time, dt, population_with_car, work
     # Convert current time to hours (assuming curr_time is in seconds)
     curr_hour = (curr_time / 3600.0) % 24
     
-    if weekday==True:
-        if 0 <= curr_hour < 5:
-            target_vehicles = population_with_car*0.001  # 0.1% of people at night per hour
-        elif 5<= curr_hour < 9:
-            target_vehicles = working_population*(1/3.) # working population with car, go to work over 3 hours
-        elif 9 <= curr_hour < 11:
-            target_vehicles = inactive_population*0.2*(1/2.)  # 20% of people that stay at home, over 2 hours do something in the morning
-        elif 11 <= curr_hour < 13:
-            target_vehicles = working_population*0.5*(1/2.)  # 50% of workers go home for lunch,, over two hours
-        elif 13 <= curr_hour < 16:
-            target_vehicles = inactive_population*0.15*(1/3.)   # 15 % drive around at afternoon
-        elif 16 <= curr_hour < 19:
-            target_vehicles = working_population*(1/3.)  # working population with car, come home from work over 3 hours
-        elif 19 <= curr_hour < 21:
-            target_vehicles = population_with_car*0.1*(1/2.)  # 10% of people do something in the evening, over 2 hours
-        else:  # 21-24
-            target_vehicles = population_with_car*0.001 # 0.1% of people at night per hour
-    else:
-        # Weekend traffic pattern
-        if 0 <= curr_hour < 5:
-            target_vehicles = population_with_car*0.001 # 0.1% of people at night per hour
-        elif 5<= curr_hour < 8:
-            target_vehicles = population_with_car*0.05*(1/3.) # 5% of people do somehting in the morning
-        elif 9 <= curr_hour < 18:
-            target_vehicles = population_with_car*0.25 # 25% of people do something during the day -> assuming that families use one car
-        elif 18 <= curr_hour < 21:
-            target_vehicles = population_with_car*0.05*(1/3.) # 5% of peoplen do something in the evening
-        else:  # 21-24
-            target_vehicles = population_with_car*0.001 # 0.1% of people at night per hour
-            
+    # Vehicles per hour from the lookup table of the current hour
+    shares_table, spread_table = WEEKDAY_TRAFFIC if weekday==True else WEEKEND_TRAFFIC
+    hour = int(curr_hour)
+    target_vehicles = (shares_table[hour] @ np.array([population_with_car, working_population, inactive_population], dtype=np.float64)) * spread_table[hour]
+
     target_vehicles = int(target_vehicles)
     # Ensure target_vehicles is at least 1 per hour
     target_vehicles = max(target_vehicles, 1)
@@ -335,23 +472,15 @@ def add_time_dependent_traffic(weekday, curr_time, dt, population_with_car, work
     # Expected vehicles per time step
     expected_vehicles = vehicles_per_second * dt
     
-    # Probabilistic approach to spawn vehicles
-    if random.random() < expected_vehicles:
+    # Probabilistic approach to spawn vehicles: number of new vehicles in this time step in one draw (mean expected_vehicles)
+    n_spawn = rng.poisson(expected_vehicles)
+    for _ in range(n_spawn):
         try:
             add_random_delivery_vehicle()
         except Exception as e:
             # Catch and log any exceptions but don't let them crash the simulation
             print(f"Error spawning vehicle: {e}")
-    
-    # For higher rates
-    if expected_vehicles > 1:
-        for _ in range(expected_vehicles):
-            try:
-                add_random_delivery_vehicle()
-            except Exception as e:
-                # Catch and log any exceptions but don't let them crash the simulation
-                print(f"Error spawning additional vehicle: {e}")
-                continue
+            continue
 
 
 def create_delivery_vehicle_type():